@@ -0,0 +1,374 @@
+# Time each stage of the process on synthetic data, to catch performance regressions before a large run.
+#
+# A list of MusicBrainz tags (like mapping/mb_tags.csv) and an AcousticBrainz data file are generated for each
+# number of rows given with --rows, and each stage is run on them:
+#   count     - datafile-to-genrelist.py
+#   tag_index - building the tag index (tag_index.py)
+#   match     - main.py, including loading the tags and writing the output
+#   compare   - only matching the genres (threaded_match_genres)
+#   generate  - generate_mb_tags_for_source.py
+#   stats     - stats.count_files
+#   upload    - upload_tags.py, submitting to a local mock server (mock_musicbrainz.py)
+# Each stage is run --repeat times, each time in a new process, and the time and peak memory use is recorded.
+# Generated files are kept in --data-dir, and reused by later runs with the same parameters.
+#
+#   python benchmark.py --rows 10000 100000 1000000 -o results.json
+#   python benchmark.py --rows 10000 100000 1000000 --compare results.json
+
+import argparse
+import collections
+import contextlib
+import csv
+import datetime
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import datafiles
+import generate_mb_tags_for_source
+import main as matching
+import stats
+import tag_index
+
+genrelist = importlib.import_module("datafile-to-genrelist")
+
+STAGES = ["count", "tag_index", "match", "compare", "generate", "stats", "upload"]
+# The stages that make the files that a stage reads
+REQUIRES = {
+    "match": ["count", "tag_index"],
+    "compare": ["count", "tag_index"],
+    "generate": ["match"],
+    "upload": ["generate"],
+}
+# How much slower a stage can be than in the --compare results before it's reported as a regression
+DEFAULT_THRESHOLD = 0.2
+
+# Syllables for making up tag names
+SYLLABLES = ["ro", "ck", "pop", "ja", "zz", "me", "tal", "fo", "lk", "ho", "use", "tech", "no", "dub", "st", "ep",
+             "pu", "nk", "so", "ul", "bl", "ues", "ha", "rd", "co", "re", "am", "bi", "ent", "tra", "nce", "gr",
+             "ind", "el", "ec", "tro", "ni", "ca", "la", "ti", "sy", "nth", "wa", "ve", "bo", "ss", "di", "sco"]
+
+
+class SyntheticData(NamedTuple):
+    mb_tags: str
+    mb_tags_index: str
+    datafile: str
+    # files written by the stages
+    counts: str
+    matches: str
+    tags: str
+
+
+# Stage output files, which are made by running the stage if another stage needs them
+STAGE_OUTPUTS = {
+    "count": "counts",
+    "tag_index": "mb_tags_index",
+    "match": "matches",
+    "generate": "tags",
+}
+
+
+def make_name(rng: random.Random) -> str:
+    words = []
+    for _ in range(rng.choice([1, 1, 2, 2, 2, 3])):
+        words.append("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3))))
+    return " ".join(words)
+
+
+def generate_mb_tags(path: str, num_tags: int, rng: random.Random) -> List[str]:
+    """Write a list of MusicBrainz tags like mapping/mb_tags.csv, with about 1 in 50 tags marked as genres,
+    and return the names of the tags"""
+    names = set()
+    while len(names) < num_tags:
+        names.add(make_name(rng))
+    names = list(names)
+    rng.shuffle(names)
+    num_genres = max(num_tags // 50, 1)
+    genres = sorted(names[:num_genres])
+    others = sorted(names[num_genres:])
+    with open(path, "w") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["name", "ref_count", "has_genre"])
+        for name in genres:
+            writer.writerow([name, rng.randint(1, 100000), "t"])
+        for name in others:
+            writer.writerow([name, int(rng.paretovariate(1.2)), "f"])
+    return genres + others
+
+
+def make_service_genre(mb_names: List[str], rng: random.Random) -> str:
+    """A genre name like the ones in the data files: mostly MusicBrainz tags, sometimes written differently
+    (so they only match after processing), and sometimes not matching any tag"""
+    r = rng.random()
+    if r < 0.6:
+        return rng.choice(mb_names)
+    elif r < 0.8:
+        name = rng.choice(mb_names)
+        return rng.choice([name.replace(" ", ""), name.replace(" ", "-"), name.replace(" ", " & "), name.upper()])
+    return make_name(rng) + rng.choice(SYLLABLES)
+
+
+def generate_datafile(path: str, num_rows: int, num_genres: int, mb_names: List[str], rng: random.Random):
+    """Write an AcousticBrainz data file with `num_rows` recordings using `num_genres` different genres, some of
+    which are much more common than others"""
+    parents = [make_service_genre(mb_names, rng) for _ in range(max(num_genres // 20, 1))]
+    genres = list(parents)
+    while len(genres) < num_genres:
+        genres.append(f"{rng.choice(parents)}---{make_service_genre(mb_names, rng)}")
+    weights = [1 / (i + 1) for i in range(len(genres))]
+    with open(path, "w", newline="") as fp:
+        writer = csv.writer(fp, dialect=csv.excel_tab)
+        writer.writerow(["recordingmbid", "releasegroupmbid", "genre1", "genre2", "genre3", "genre4", "genre5"])
+        for _ in range(num_rows):
+            row_genres = set(rng.choices(genres, weights, k=rng.randint(1, 5)))
+            writer.writerow([uuid.UUID(int=rng.getrandbits(128), version=4),
+                             uuid.UUID(int=rng.getrandbits(128), version=4)] + sorted(row_genres))
+
+
+def generate_data(data_dir: str, num_rows: int, num_tags: int, num_genres: int, seed: int) -> SyntheticData:
+    """Generate the input files for a benchmark, unless they were already generated with the same parameters"""
+    prefix = os.path.join(data_dir, f"seed{seed}")
+    mb_tags = f"{prefix}-mb_tags-{num_tags}.csv"
+    datafile = f"{prefix}-data-{num_rows}-{num_tags}-{num_genres}.tsv"
+    data = SyntheticData(mb_tags=mb_tags, mb_tags_index=tag_index.default_index_path(mb_tags), datafile=datafile,
+                         counts=f"{datafile}.counts.csv", matches=f"{datafile}.matches.csv",
+                         tags=f"{datafile}.tags.csv")
+
+    rng = random.Random(seed)
+    if os.path.exists(mb_tags):
+        with open(mb_tags) as fp:
+            mb_names = [row["name"] for row in csv.DictReader(fp)]
+    else:
+        print(f"Generating {mb_tags}", file=sys.stderr)
+        mb_names = generate_mb_tags(mb_tags, num_tags, rng)
+    if not os.path.exists(datafile):
+        print(f"Generating {datafile}", file=sys.stderr)
+        rng = random.Random(f"{seed}-{num_rows}")
+        generate_datafile(datafile, num_rows, num_genres, mb_names, rng)
+        for stage_output in STAGE_OUTPUTS.values():
+            path = getattr(data, stage_output)
+            if stage_output != "mb_tags_index" and os.path.exists(path):
+                os.remove(path)
+    return data
+
+
+# Each stage function gets everything ready, and returns a function that runs the part of the stage that is timed
+
+def stage_count(data: SyntheticData, num_workers: int) -> Callable:
+    def run():
+        with open(data.counts, "w") as fp, contextlib.redirect_stdout(fp):
+            genrelist.main([data.datafile], num_workers)
+    return run
+
+
+def stage_tag_index(data: SyntheticData, num_workers: int) -> Callable:
+    return lambda: tag_index.build_tag_index(data.mb_tags, data.mb_tags_index)
+
+
+def stage_match(data: SyntheticData, num_workers: int) -> Callable:
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            matching.main(data.mb_tags, data.counts, outfile=data.matches, num_workers=num_workers, quiet=True)
+    return run
+
+
+def stage_compare(data: SyntheticData, num_workers: int) -> Callable:
+    mb_index = matching.load_musicbrainz_genres(data.mb_tags)
+    data_genres = matching.load_data_genres(data.counts)
+    manual_mapping = collections.defaultdict(list)
+    return lambda: matching.threaded_match_genres(data_genres, mb_index, manual_mapping, num_workers=num_workers)
+
+
+def stage_generate(data: SyntheticData, num_workers: int) -> Callable:
+    def run():
+        with open(data.tags, "w") as fp, contextlib.redirect_stdout(fp):
+            generate_mb_tags_for_source.main([data.datafile], data.matches, num_workers)
+    return run
+
+
+def stage_stats(data: SyntheticData, num_workers: int) -> Callable:
+    return lambda: stats.count_files([data.datafile], num_workers)
+
+
+def stage_upload(data: SyntheticData, num_workers: int) -> Callable:
+    import musicbrainzngs
+    import mock_musicbrainz
+    import upload_tags
+
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(f"{data.tags}.submitcache.db{suffix}"):
+            os.remove(f"{data.tags}.submitcache.db{suffix}")
+    server = mock_musicbrainz.serve(0)
+    musicbrainzngs.set_hostname(f"localhost:{server.server_address[1]}", False)
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            upload_tags.main("rec", data.tags, rate_limit_requests=1000000)
+    return run
+
+
+STAGE_FUNCTIONS = {
+    "count": stage_count,
+    "tag_index": stage_tag_index,
+    "match": stage_match,
+    "compare": stage_compare,
+    "generate": stage_generate,
+    "stats": stage_stats,
+    "upload": stage_upload,
+}
+
+
+def max_rss_mb(who) -> float:
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports this in kilobytes, and macOS in bytes
+    if sys.platform == "darwin":
+        maxrss /= 1024
+    return round(maxrss / 1024, 1)
+
+
+def _run_stage_in_process(stage: str, data: SyntheticData, num_workers: int, conn):
+    run = STAGE_FUNCTIONS[stage](data, num_workers)
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+    conn.send({
+        "seconds": seconds,
+        "peak_rss_mb": max_rss_mb(resource.RUSAGE_SELF),
+        # the largest of any worker processes that the stage started
+        "peak_child_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN),
+    })
+    conn.close()
+
+
+def run_stage(stage: str, data: SyntheticData, num_workers: int) -> Dict:
+    """Run a stage in a new process, so that its memory use is measured separately from other stages"""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_stage_in_process, args=(stage, data, num_workers, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"stage {stage} failed")
+    finally:
+        process.join()
+    return result
+
+
+def ensure_inputs(stage: str, data: SyntheticData, num_workers: int):
+    """Run the stages that make the files that `stage` reads, if they haven't been made yet"""
+    for required in REQUIRES.get(stage, []):
+        ensure_inputs(required, data, num_workers)
+        if not os.path.exists(getattr(data, STAGE_OUTPUTS[required])):
+            print(f"  running {required} to make its output", file=sys.stderr)
+            run_stage(required, data, num_workers)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results: Dict, baseline: Dict, threshold: float) -> bool:
+    """Print how long each stage took compared to the baseline results, and return True if any were slower than
+    the threshold"""
+    baseline_times = {(r["stage"], r["rows"]): r["median_seconds"] for r in baseline["results"]}
+    regressed = False
+    for r in results["results"]:
+        before = baseline_times.get((r["stage"], r["rows"]))
+        if not before:
+            continue
+        change = r["median_seconds"] / before - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{r['stage']:>10} {r['rows']:>9} rows: {before:.3f}s -> {r['median_seconds']:.3f}s "
+              f"({change:+.0%}){flag}", file=sys.stderr)
+    return regressed
+
+
+def main(rows: List[int], num_tags: int, num_genres: int, stages: List[str], repeat: int, num_workers: int,
+         data_dir: str, seed: int, outfile: Optional[str] = None, baseline_file: Optional[str] = None,
+         threshold: float = DEFAULT_THRESHOLD) -> bool:
+    os.makedirs(data_dir, exist_ok=True)
+    results = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": datafiles.default_num_workers(),
+        "parameters": {"tags": num_tags, "genres": num_genres, "repeat": repeat, "workers": num_workers,
+                       "seed": seed},
+        "results": [],
+    }
+    for num_rows in rows:
+        data = generate_data(data_dir, num_rows, num_tags, num_genres, seed)
+        for stage in stages:
+            ensure_inputs(stage, data, num_workers)
+            runs = [run_stage(stage, data, num_workers) for _ in range(repeat)]
+            seconds = [r["seconds"] for r in runs]
+            result = {
+                "stage": stage,
+                "rows": num_rows,
+                "seconds": seconds,
+                "min_seconds": min(seconds),
+                "median_seconds": statistics.median(seconds),
+                "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+                "peak_child_rss_mb": max(r["peak_child_rss_mb"] for r in runs),
+            }
+            results["results"].append(result)
+            print(f"{stage:>10} {num_rows:>9} rows: {result['median_seconds']:.3f}s, "
+                  f"{result['peak_rss_mb']}MB (workers {result['peak_child_rss_mb']}MB)", file=sys.stderr)
+
+    if outfile and outfile != "-":
+        with open(outfile, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if baseline_file:
+        with open(baseline_file) as fp:
+            baseline = json.load(fp)
+        return not compare_results(results, baseline, threshold)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help='Number of recordings in the data file, one benchmark for each (default 10000 100000)')
+    parser.add_argument('--tags', type=int, default=200000, help='Number of MusicBrainz tags (default 200000)')
+    parser.add_argument('--genres', type=int, default=1000,
+                        help='Number of different genres in the data file (default 1000)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run (default all)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to run each stage (default 3)')
+    parser.add_argument('-j', '--workers', type=int, default=datafiles.default_num_workers(),
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--data-dir', default='benchmark-data', help='Directory for generated files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', required=False, help='File to write the results to as json (default stdout)')
+    parser.add_argument('--compare', required=False,
+                        help='Results file from an earlier run. Exit with an error if any stage is slower')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'How much slower a stage can be before it counts as slower (default {DEFAULT_THRESHOLD})')
+    args = parser.parse_args()
+    ok = main(args.rows, args.tags, args.genres, args.stages, args.repeat, args.workers, args.data_dir, args.seed,
+              args.o, args.compare, args.threshold)
+    sys.exit(0 if ok else 1)
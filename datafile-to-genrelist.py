@@ -1,32 +1,71 @@
 # Take any number of datafiles (e.g. acousticbrainz-mediaeval-discogs-train.tsv) and extract out
 # all genres, deduplicate, and write out in sorted order.
+# Datafiles can be compressed with bzip2, gzip, or xz.
+# Files are split into chunks which are counted in parallel, and the counts for all files are added together.
 import argparse
+import concurrent.futures
 import csv
 import sys
 from collections import Counter
+from typing import Dict, List, Optional
 
+import datafiles
 
-def main(datafiles):
-    data_genres = set()
-    for f in datafiles:
-        data_genres = Counter()
-        with open(f) as fp:
-            r = csv.reader(fp, dialect=csv.excel_tab)
-            next(r)
-            for line in r:
-                for genre in line[2:]:
-                    if genre:
-                        data_genres[genre] += 1
 
-    writer = csv.DictWriter(sys.stdout, fieldnames=["genre", "count"])
+def count_genres(chunk: datafiles.DataChunk) -> Counter:
+    """Count how many times each genre appears in a chunk of a data file"""
+    data_genres = Counter()
+    for line in datafiles.read_rows(chunk):
+        data_genres.update(genre for genre in line[2:] if genre)
+    return data_genres
+
+
+def _count_chunk(chunk: datafiles.DataChunk):
+    return chunk.datafile, count_genres(chunk)
+
+
+def count_files(datafile_names: List[str], num_workers: Optional[int] = None) -> Dict[str, Counter]:
+    """Count the genres in each data file"""
+    if num_workers is None:
+        num_workers = datafiles.default_num_workers()
+    file_genres = {f: Counter() for f in datafile_names}
+    chunks = (chunk for f in datafile_names for chunk in datafiles.iter_chunks(f))
+    if num_workers <= 1:
+        for chunk in chunks:
+            file_genres[chunk.datafile].update(count_genres(chunk))
+        return file_genres
+
+    # Merge the counts in the order of the chunks, so that genres are always in the order that they are first seen
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for datafile, counts in datafiles.imap_ordered(executor, _count_chunk, chunks, num_workers * 2):
+            file_genres[datafile].update(counts)
+    return file_genres
+
+
+def main(datafile_names, num_workers=None, per_file=False):
+    file_genres = count_files(datafile_names, num_workers)
+    data_genres = Counter()
+    for counts in file_genres.values():
+        data_genres.update(counts)
+
+    fieldnames = ["genre", "count"]
+    if per_file:
+        fieldnames += datafile_names
+    writer = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
     writer.writeheader()
     for genre, count in data_genres.items():
-        writer.writerow({"genre": genre, "count": count})
+        row = {"genre": genre, "count": count}
+        if per_file:
+            for f in datafile_names:
+                row[f] = file_genres[f][genre]
+        writer.writerow(row)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--workers', type=int, required=False,
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--per-file', action='store_true', help='Also include a count column for each datafile')
     parser.add_argument('datafile', nargs='+')
     args = parser.parse_args()
-    main(args.datafile)
-
+    main(args.datafile, args.workers, args.per_file)
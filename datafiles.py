@@ -0,0 +1,278 @@
+# Read AcousticBrainz genre data files (e.g. acousticbrainz-mediaeval-discogs-train.tsv) in parallel.
+# Data files are tab separated with a header line, and one recording per line:
+#   recordingmbid, releasegroupmbid, genre1, genre2, ...
+# A file is split into chunks that start and end on a line boundary, so that each chunk
+# can be read and processed by a different worker.
+#
+# Data files can also be compressed with bzip2, gzip, or xz (e.g. acousticbrainz-mediaeval-discogs-train.tsv.bz2),
+# in which case they are decompressed as they are read. bzip2 files are split into their compressed blocks,
+# which are decompressed in parallel.
+
+import bz2
+import collections
+import concurrent.futures
+import csv
+import gzip
+import io
+import lzma
+import mmap
+import os
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+# Size of each chunk that a data file is split into
+CHUNK_BYTES = 16 * 1024 * 1024
+
+COMPRESSED_OPENERS = {
+    ".bz2": bz2.open,
+    ".gz": gzip.open,
+    ".xz": lzma.open,
+}
+
+# Every bzip2 block starts with this 48 bit value, and every stream ends with the second, followed
+# by a 32 bit CRC. They aren't byte aligned. Neither value can appear inside the compressed data
+# of a block by design, though it can by chance. See https://en.wikipedia.org/wiki/Bzip2#File_format
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_MAGIC_BITS = 48
+
+
+def default_num_workers() -> int:
+    """The number of CPUs that this process can run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def is_compressed(datafile: str) -> bool:
+    return os.path.splitext(datafile)[1] in COMPRESSED_OPENERS
+
+
+def _find_bit_pattern(data, pattern: int, nbits: int) -> List[int]:
+    """Find the bit offsets of every occurrence of an `nbits` long pattern in data, at any bit alignment"""
+    found = []
+    for shift in range(8):
+        total_bits = shift + nbits
+        nbytes = (total_bits + 7) // 8
+        pattern_bytes = (pattern << (nbytes * 8 - total_bits)).to_bytes(nbytes, "big")
+        # Search for the bytes that are completely covered by the pattern, and then check the partial bytes at the ends
+        first_full = 1 if shift else 0
+        last_full = nbytes - (1 if total_bits % 8 else 0)
+        needle = pattern_bytes[first_full:last_full]
+        position = data.find(needle)
+        while position != -1:
+            start = position - first_full
+            if start >= 0 and start + nbytes <= len(data):
+                value = int.from_bytes(data[start:start + nbytes], "big") >> (nbytes * 8 - total_bits)
+                if value & ((1 << nbits) - 1) == pattern:
+                    found.append(start * 8 + shift)
+            position = data.find(needle, position + 1)
+    return sorted(found)
+
+
+def _bz2_block_ranges(data) -> List[Tuple[int, int]]:
+    """The (start, end) bit offsets of each compressed block in bzip2 data, which may contain many streams"""
+    starts = _find_bit_pattern(data, BZ2_BLOCK_MAGIC, BZ2_MAGIC_BITS)
+    ends = sorted(starts[1:] + _find_bit_pattern(data, BZ2_EOS_MAGIC, BZ2_MAGIC_BITS))
+    ranges = []
+    end_index = 0
+    for start in starts:
+        while end_index < len(ends) and ends[end_index] <= start:
+            end_index += 1
+        if end_index == len(ends):
+            break
+        ranges.append((start, ends[end_index]))
+    return ranges
+
+
+def _decompress_bz2_block(data, start: int, end: int) -> Optional[bytes]:
+    """
+    Decompress the block between two bit offsets of bzip2 data, by making it into a stream of its own.
+    Returns None if this isn't a valid block, e.g. because one of the offsets isn't really the start of a block
+    """
+    nbits = end - start
+    block_bytes = data[start // 8:(end + 7) // 8]
+    block = int.from_bytes(block_bytes, "big") >> (len(block_bytes) * 8 - (start % 8) - nbits)
+    block &= (1 << nbits) - 1
+    if nbits < BZ2_MAGIC_BITS + 32:
+        return None
+    # The CRC of a single block stream is the CRC of the block, which comes after the block magic
+    crc = (block >> (nbits - BZ2_MAGIC_BITS - 32)) & 0xffffffff
+    stream = (((block << BZ2_MAGIC_BITS) | BZ2_EOS_MAGIC) << 32) | crc
+    stream_bits = nbits + BZ2_MAGIC_BITS + 32
+    padding = -stream_bits % 8
+    stream <<= padding
+    try:
+        return bz2.decompress(b"BZh9" + stream.to_bytes((stream_bits + padding) // 8, "big"))
+    except (OSError, ValueError):
+        return None
+
+
+def _iter_bz2(datafile: str) -> Iterator[bytes]:
+    with bz2.open(datafile, "rb") as fp:
+        yield from iter(lambda: fp.read(CHUNK_BYTES), b"")
+
+
+def iter_bz2_parallel(datafile: str, num_threads: int) -> Iterator[bytes]:
+    """
+    Yield the decompressed contents of a bzip2 file, decompressing its blocks on a pool of threads.
+    The bz2 module releases the GIL while decompressing, so threads run in parallel
+    """
+    if os.path.getsize(datafile) == 0:
+        # An empty file can't be mapped. Read it the same way as with one thread
+        yield from _iter_bz2(datafile)
+        return
+    with open(datafile, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        ranges = _bz2_block_ranges(data)
+        if not ranges:
+            # A file with no blocks, e.g. bz2 compressed empty data. bz2.open reads it if it's valid, and raises
+            # an error if it isn't bzip2 data at all
+            yield from _iter_bz2(datafile)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            # If a block didn't decompress, the offset where it ends might be a chance match of a block
+            # magic inside the compressed data. Try again, joining it to the next block
+            failed_start = None
+            results = imap_ordered(executor, lambda r: _decompress_bz2_block(data, *r), ranges, num_threads * 2)
+            for (start, end), decompressed in zip(ranges, results):
+                if failed_start is not None:
+                    decompressed = _decompress_bz2_block(data, failed_start, end)
+                    if decompressed is not None:
+                        failed_start = None
+                        yield decompressed
+                elif decompressed is None:
+                    failed_start = start
+                else:
+                    yield decompressed
+            if failed_start is not None:
+                raise OSError(f"{datafile}: invalid bzip2 data")
+
+
+class _IterReader(io.RawIOBase):
+    """A binary file that reads from an iterator of bytes"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            self._buffer = next(self._chunks, None)
+            if self._buffer is None:
+                self._buffer = b""
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+
+def open_binary(datafile: str, num_threads: Optional[int] = None):
+    """Open a data file for reading as bytes, decompressing it if needed"""
+    extension = os.path.splitext(datafile)[1]
+    if extension == ".bz2":
+        if num_threads is None:
+            num_threads = default_num_workers()
+        if num_threads > 1:
+            return io.BufferedReader(_IterReader(iter_bz2_parallel(datafile, num_threads)), CHUNK_BYTES)
+    if extension in COMPRESSED_OPENERS:
+        return COMPRESSED_OPENERS[extension](datafile, "rb")
+    return open(datafile, "rb")
+
+
+class DataChunk(NamedTuple):
+    datafile: str
+    # byte offsets in the (decompressed) file
+    start: int
+    end: int
+    # For an uncompressed file the chunk is read from the file by the worker that processes it,
+    # otherwise this is the decompressed data
+    data: Optional[bytes] = None
+
+
+def split_datafile(datafile: str, chunk_bytes: Optional[int] = None) -> List[Tuple[int, int]]:
+    """Split an uncompressed data file into (start, end) byte ranges of about chunk_bytes, each ending after a newline"""
+    if chunk_bytes is None:
+        chunk_bytes = CHUNK_BYTES
+    size = os.path.getsize(datafile)
+    if size == 0:
+        return []
+    boundaries = [0]
+    with open(datafile, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        position = chunk_bytes
+        while position < size:
+            newline = mm.find(b"\n", position)
+            if newline == -1:
+                break
+            boundaries.append(newline + 1)
+            position = newline + 1 + chunk_bytes
+    if boundaries[-1] != size:
+        boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def iter_chunks(datafile: str, chunk_bytes: Optional[int] = None) -> Iterator[DataChunk]:
+    """
+    Split a data file into chunks of about chunk_bytes, each ending after a newline.
+    Compressed files are decompressed as the chunks are requested.
+    """
+    if chunk_bytes is None:
+        chunk_bytes = CHUNK_BYTES
+    if not is_compressed(datafile):
+        for start, end in split_datafile(datafile, chunk_bytes):
+            yield DataChunk(datafile, start, end)
+        return
+
+    position = 0
+    with open_binary(datafile) as fp:
+        remainder = b""
+        while True:
+            block = fp.read(chunk_bytes)
+            data = remainder + block
+            if not block:
+                break
+            newline = data.rfind(b"\n")
+            if newline == -1:
+                remainder = data
+                continue
+            remainder = data[newline + 1:]
+            data = data[:newline + 1]
+            yield DataChunk(datafile, position, position + len(data), data)
+            position += len(data)
+        if data:
+            yield DataChunk(datafile, position, position + len(data), data)
+
+
+def read_rows(chunk: DataChunk):
+    """Yield the rows of a chunk of a data file, skipping the header line if it's the first chunk"""
+    if chunk.data is not None:
+        text = chunk.data.decode("utf-8")
+    else:
+        with open(chunk.datafile, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            text = mm[chunk.start:chunk.end].decode("utf-8")
+    reader = csv.reader(io.StringIO(text, newline=""), dialect=csv.excel_tab)
+    if chunk.start == 0:
+        next(reader, None)
+    yield from reader
+
+
+def imap_ordered(executor, fn, iterable, window: int):
+    """
+    Like executor.map, yield fn(item) for each item in order, but keep at most `window` items
+    in progress, so that results which are ready early don't build up in memory
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
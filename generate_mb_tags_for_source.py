@@ -1,12 +1,27 @@
 # Given a data file and a mapping file, generate a list of musicbrainz tags to upload
 
 import argparse
+import array
+import concurrent.futures
 import csv
-from typing import List
+import io
+from typing import Dict, List, NamedTuple, Optional, Tuple
 import sys
 
+import datafiles
+import tag_matrix
 
-def main(datafiles: List[str], mapping_file: str):
+
+def row_tags(row: List[str]) -> List[str]:
+    """
+    The tags to submit from a row of a file written by main.py: parent genre, subgenre, then groups of
+    mb tag, type, genre?. Near misses from main.py --fuzzy (types starting with "fuzzy") are only suggestions
+    to review, so they aren't submitted
+    """
+    return [tag for tag, match_type in zip(row[2::3], row[3::3]) if tag and not match_type.startswith("fuzzy")]
+
+
+def load_mapping(mapping_file: str) -> Dict[str, List[str]]:
     mapping_genre_to_tags = {}
     with open(mapping_file) as fp:
         reader = csv.reader(fp)
@@ -14,35 +29,174 @@ def main(datafiles: List[str], mapping_file: str):
         for line in reader:
             genre = line[0]
             subgenre = line[1]
-            # fields are 'tag,matchtype,is_genre', just extract the tag
-            tags = line[2::3]
-            tags = [t for t in tags if t]
+            tags = row_tags(line)
             if subgenre:
                 genre = f"{genre}---{subgenre}"
             mapping_genre_to_tags[genre] = tags
-    
-    for datafile in datafiles:
-        writer = csv.writer(sys.stdout)
-        with open(datafile) as fp:
-            reader = csv.reader(fp, dialect=csv.excel_tab)
-            next(reader)
-            for line in reader:
-                mbid = line[0]
-                tags = [t for t in line[2:] if t]
-                mb_tags = set()
-                for t in tags:
-                    mapped_tags = mapping_genre_to_tags[t]
-                    if mapped_tags:
-                        mb_tags.update(mapped_tags)
-                if mb_tags:
-                    writer.writerow([mbid] + sorted(list(mb_tags)))
+    return mapping_genre_to_tags
+
+
+def expand_tags(chunk: datafiles.DataChunk, mapping_genre_to_tags: Dict[str, List[str]]) -> str:
+    """Map the genres of each recording in a chunk of a data file to musicbrainz tags, and return them as csv"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    # Many recordings have the same genres, so only work out the tags for each combination once
+    tags_for_genres = {}
+    for line in datafiles.read_rows(chunk):
+        mbid = line[0]
+        genres = tuple(t for t in line[2:] if t)
+        mb_tags = tags_for_genres.get(genres)
+        if mb_tags is None:
+            mb_tags = set()
+            for t in genres:
+                mapped_tags = mapping_genre_to_tags[t]
+                if mapped_tags:
+                    mb_tags.update(mapped_tags)
+            mb_tags = sorted(mb_tags)
+            tags_for_genres[genres] = mb_tags
+        if mb_tags:
+            writer.writerow([mbid] + mb_tags)
+    return out.getvalue()
+
+
+def tag_numbers(mapping_genre_to_tags: Dict[str, List[str]]) -> Tuple[List[str], Dict[str, Tuple[int, ...]]]:
+    """Number each tag in a mapping, and give the tag numbers of each genre. Tags are numbered in sorted order,
+    so sorting the numbers of a recording's tags gives the same order as sorting their names"""
+    tags = sorted({tag for genre_tags in mapping_genre_to_tags.values() for tag in genre_tags})
+    numbers = {tag: i for i, tag in enumerate(tags)}
+    return tags, {genre: tuple(numbers[tag] for tag in genre_tags) for genre, genre_tags in mapping_genre_to_tags.items()}
+
+
+class TagIds(NamedTuple):
+    # the mbid of each recording with at least one tag, as 16 bytes each
+    mbids: bytearray
+    # the number of tags of each recording
+    lengths: array.array
+    # the tag numbers of all recordings, one after the other
+    indices: array.array
+    # the number of recordings that were skipped because their mbid isn't valid
+    invalid: int
+
+
+def expand_tag_ids(chunk: datafiles.DataChunk, genre_tag_numbers: Dict[str, Tuple[int, ...]]) -> TagIds:
+    """Like expand_tags, but return the tag numbers of each recording (see tag_numbers), to write a tag matrix"""
+    result = TagIds(bytearray(), array.array("I"), array.array("I"), 0)
+    invalid = 0
+    tags_for_genres = {}
+    for line in datafiles.read_rows(chunk):
+        genres = tuple(t for t in line[2:] if t)
+        tag_ids = tags_for_genres.get(genres)
+        if tag_ids is None:
+            tag_ids = sorted({t for genre in genres for t in genre_tag_numbers[genre]})
+            tags_for_genres[genres] = tag_ids
+        if tag_ids:
+            try:
+                result.mbids.extend(tag_matrix.mbid_bytes(line[0]))
+            except ValueError:
+                invalid += 1
+                continue
+            result.lengths.append(len(tag_ids))
+            result.indices.extend(tag_ids)
+    return result._replace(invalid=invalid)
+
+
+def write_matrix(path: str, tags: List[str], results):
+    """Write the tag numbers from expand_tag_ids as a tag matrix. Rows are sorted by mbid, and if a recording is
+    in the data files more than once, only its last row is kept (the same as upload_tags.py does with a csv)"""
+    mbids = bytearray()
+    lengths = array.array("I")
+    indices = array.array("I")
+    invalid = 0
+    for result in results:
+        mbids += result.mbids
+        lengths += result.lengths
+        indices += result.indices
+        invalid += result.invalid
+    starts = array.array("Q", [0])
+    for length in lengths:
+        starts.append(starts[-1] + length)
+
+    size = tag_matrix.MBID_SIZE
+    keys = [bytes(mbids[i:i + size]) for i in range(0, len(mbids), size)]
+    del mbids
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    sorted_mbids = bytearray()
+    indptr = array.array("Q", [0])
+    sorted_indices = array.array("I")
+    for position, row in enumerate(order):
+        mbid = keys[row]
+        # sorted() keeps rows with the same mbid in file order, so the last one is the one to keep
+        if position + 1 < len(order) and keys[order[position + 1]] == mbid:
+            continue
+        sorted_mbids += mbid
+        sorted_indices += indices[starts[row]:starts[row + 1]]
+        indptr.append(len(sorted_indices))
+    tag_matrix.write_tag_matrix(path, tags, sorted_mbids, indptr, sorted_indices)
+    if invalid:
+        print(f"Skipped {invalid} recordings with an invalid mbid", file=sys.stderr)
+
+
+# Set in each worker process by _init_worker, so that the mapping is only sent to a worker once
+_worker_mapping = None
+
+
+def _init_worker(mapping_genre_to_tags):
+    global _worker_mapping
+    _worker_mapping = mapping_genre_to_tags
+
+
+def _expand_tags_in_worker(chunk):
+    return expand_tags(chunk, _worker_mapping)
+
+
+def _expand_tag_ids_in_worker(chunk):
+    return expand_tag_ids(chunk, _worker_mapping)
+
+
+def main(datafile_names: List[str], mapping_file: str, num_workers: Optional[int] = None,
+         matrix_file: Optional[str] = None):
+    mapping_genre_to_tags = load_mapping(mapping_file)
+    if num_workers is None:
+        num_workers = datafiles.default_num_workers()
+
+    if matrix_file:
+        tags, mapping = tag_numbers(mapping_genre_to_tags)
+        expand, expand_in_worker = expand_tag_ids, _expand_tag_ids_in_worker
+    else:
+        mapping = mapping_genre_to_tags
+        expand, expand_in_worker = expand_tags, _expand_tags_in_worker
+
+    chunks = (chunk for datafile in datafile_names for chunk in datafiles.iter_chunks(datafile))
+    if num_workers <= 1:
+        results = (expand(chunk, mapping) for chunk in chunks)
+        if matrix_file:
+            write_matrix(matrix_file, tags, results)
+        else:
+            for text in results:
+                sys.stdout.write(text)
+        return
+
+    # Chunks are processed in parallel, but written in the same order as they are in the data files
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                                initargs=(mapping, )) as executor:
+        results = datafiles.imap_ordered(executor, expand_in_worker, chunks, num_workers * 2)
+        if matrix_file:
+            write_matrix(matrix_file, tags, results)
+        else:
+            for text in results:
+                sys.stdout.write(text)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--workers', type=int, required=False,
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--matrix', required=False,
+                        help='Write the tags to this file as a tag matrix (see tag_matrix.py), instead of as csv '
+                             'to stdout')
     parser.add_argument('mapping', help='Mapping file')
-    parser.add_argument('data', nargs='+', help='Data file(s)')
+    parser.add_argument('data', nargs='+', help='Data file(s), optionally compressed with bzip2, gzip, or xz')
 
     args = parser.parse_args()
 
-    main(args.data, args.mapping)
\ No newline at end of file
+    main(args.data, args.mapping, args.workers, args.matrix)
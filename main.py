@@ -1,20 +1,45 @@
 import argparse
+import array
 import collections
+import contextlib
+import cProfile
 import csv
 import concurrent.futures
+import json
+import os
 import sys
 from enum import Enum, auto
 import math
 import time
 from dataclasses import dataclass, field
-from typing import Optional, List, Dict, Set
+from typing import Optional, List, Dict, Mapping, NamedTuple, Set, Sequence, Tuple, Union
 
 from thefuzz import fuzz
-from thefuzz import utils
+
+import datafiles
+import generate_mb_tags_for_source
+import match_cache
+import tag_index
+from normalize import normalize, sorted_tokens, sorted_tokens_all
 
 
 DEBUG = False
 
+# length of the character n-grams used to find candidates for fuzzy matching
+NGRAM_SIZE = 2
+
+# Matching a genre without near misses takes 15-70 microseconds with the tags read from a tag index (more for genres
+# that match many tags), and starting a pool of workers takes a few tenths of a second, so below this many genres
+# it's faster to match them all in this process than to start a pool of workers
+SERIAL_THRESHOLD = 10000
+# Finding near misses is much slower, so use workers for all but the smallest inputs
+SERIAL_THRESHOLD_FUZZY = 20
+# Split the genres into about this many chunks for each worker
+CHUNKS_PER_WORKER = 8
+MAX_CHUNK_SIZE = 1000
+
+OUTPUT_HEADER = ["source parent genre", "source subgenre"] + ["mb tag", "type", "genre?"] * 4
+
 
 class MatchType(Enum):
     # genre + subgenre
@@ -29,6 +54,12 @@ class MatchType(Enum):
     EXACT = auto()
     # manual mapping
     MANUAL = auto()
+    # near misses, only with --fuzzy. genre + subgenre
+    FUZZY_FULLGENRE = auto()
+    # near miss on only genre
+    FUZZY_PARENTGENRE = auto()
+    # near miss on only subgenre
+    FUZZY_SUBGENRE = auto()
 
 
 @dataclass(unsafe_hash=True)
@@ -55,12 +86,11 @@ class ServiceGenre:
             return self.parent_genre
 
     def __post_init__(self):
-        self.processed_parent_genre = utils.full_process(self.parent_genre).replace(" ", "")
-        self.processed_full_genre_words = utils.full_process(self.full_genre)
-        self.processed_full_genre = self.processed_full_genre_words.replace(" ", "")
+        self.processed_parent_genre = normalize(self.parent_genre).key
+        self.processed_full_genre_words, self.processed_full_genre = normalize(self.full_genre)
         if self.subgenre:
             self.lowercase_subgenre = self.subgenre.lower()
-            self.processed_subgenre = utils.full_process(self.subgenre).replace(" ", "")
+            self.processed_subgenre = normalize(self.subgenre).key
         else:
             self.lowercase_subgenre = None
             self.processed_subgenre = None
@@ -75,13 +105,16 @@ class MusicBrainzGenre:
     tag_count: int
 
     # processed version of name, a-z, no spaces
-    processed_name: str = field(init=False)
+    processed_name: Optional[str] = None
     # same as above, but with spaces between words
-    processed_name_words: str = field(init=False)
+    processed_name_words: Optional[str] = None
 
     def __post_init__(self):
-        self.processed_name_words = utils.full_process(self.name)
-        self.processed_name = self.processed_name_words.replace(" ", "")
+        # These are already set if we loaded the tag from a tag index
+        if self.processed_name_words is None:
+            self.processed_name_words = normalize(self.name).words
+        if self.processed_name is None:
+            self.processed_name = normalize(self.name).key
 
 
 @dataclass
@@ -92,32 +125,484 @@ class MatchResult:
     match_type: MatchType
 
 
+def ngrams(s: str) -> List[str]:
+    return [s[i:i + NGRAM_SIZE] for i in range(len(s) - NGRAM_SIZE + 1)]
+
+
+def _position_table(keys: List[str]) -> Dict[str, Union[int, Tuple[int, ...]]]:
+    """
+    Map each key to the positions in `keys` where it appears.
+    Most keys belong to a single tag, so store those as a bare position instead of a tuple
+    """
+    table = dict(zip(keys, range(len(keys))))
+    if len(table) < len(keys):
+        counts = collections.Counter(keys)
+        duplicates = {key: [] for key, count in counts.items() if count > 1}
+        for position, key in enumerate(keys):
+            if key in duplicates:
+                duplicates[key].append(position)
+        for key, positions in duplicates.items():
+            table[key] = tuple(positions)
+    return table
+
+
+def _lookup_positions(table: Mapping[str, Union[int, Tuple[int, ...]]], key: str) -> Tuple[int, ...]:
+    positions = table.get(key, ())
+    if isinstance(positions, int):
+        return (positions, )
+    return positions
+
+
+class MusicBrainzGenreIndex:
+    """
+    A table of MusicBrainz tags, with lookup tables over it.
+    Tags are stored by column (name, processed name, is_genre, ref_count) instead of as a MusicBrainzGenre
+    for each tag. MusicBrainzGenres are only made for tags that are part of a match.
+    We only keep matches with a ratio of 100, so each match type is an equality test on
+    a normalized key. Instead of comparing every service genre with every tag, index each
+    tag once by these keys and look genres up directly.
+    Each table maps a key to the positions of the tags with that key.
+    An index made with `from_tag_index` reads the tags and tables from a tag index file instead (see tag_index.py).
+    """
+
+    def __init__(self, names: List[str], processed_names: List[str], is_genre: bytes, tag_counts: Sequence[int],
+                 sorted_token_keys: List[str]):
+        """
+        :param names: the name of each tag
+        :param processed_names: the processed name of each tag, a-z, no spaces
+        :param is_genre: 1 for each tag that is a genre, 0 if not
+        :param tag_counts: the ref_count of each tag
+        :param sorted_token_keys: sorted_tokens() of each tag's processed name with spaces
+        """
+        self.tag_index = None
+        self.names = names
+        self.processed_names = list(map(sys.intern, processed_names))
+        self.is_genre = bytes(is_genre)
+        self.tag_counts = array.array("q", tag_counts)
+        # processed_name, used for SUBGENRE, PARENTGENRE and FULLGENRE matches
+        self.by_processed_name = _position_table(self.processed_names)
+        # name.lower(), used for EXACT matches
+        self.by_lowercase_name = _position_table([name.lower() for name in self.names])
+        # sorted words of processed_name_words, used for TOKENSORT matches
+        self.by_sorted_tokens = _position_table(sorted_token_keys)
+
+    @classmethod
+    def from_tag_index(cls, index: tag_index.TagIndex) -> "MusicBrainzGenreIndex":
+        """
+        Use the columns and lookup tables of a tag index without loading them. Each lookup is a binary search of
+        the index file, so this takes the same time for any number of tags, and worker processes
+        map the same file instead of being sent a copy of the tags
+        """
+        mb_index = cls.__new__(cls)
+        mb_index.tag_index = index
+        mb_index.names = index.lazy_column("name")
+        mb_index.processed_names = index.lazy_column("processed_name")
+        mb_index.is_genre = index.is_genre
+        mb_index.tag_counts = index.ref_count
+        mb_index.by_processed_name = index.key_table("processed_name")
+        mb_index.by_lowercase_name = index.key_table("lowercase_name")
+        mb_index.by_sorted_tokens = index.key_table("sorted_tokens")
+        return mb_index
+
+    def __reduce_ex__(self, protocol):
+        if self.tag_index is not None:
+            # The fuzzy matching tables take longer to build than to send, so send them if they've been built
+            state = {name: getattr(self, name) for name in ("names_by_length", "ngrams_by_length")
+                     if hasattr(self, name)}
+            return MusicBrainzGenreIndex.from_tag_index, (self.tag_index, ), state or None
+        return super().__reduce_ex__(protocol)
+
+    @classmethod
+    def from_genres(cls, musicbrainz_genres: List[MusicBrainzGenre]) -> "MusicBrainzGenreIndex":
+        return cls([mbg.name for mbg in musicbrainz_genres],
+                   [mbg.processed_name for mbg in musicbrainz_genres],
+                   bytes(bool(mbg.is_genre) for mbg in musicbrainz_genres),
+                   [int(mbg.tag_count) for mbg in musicbrainz_genres],
+                   sorted_tokens_all(mbg.processed_name_words for mbg in musicbrainz_genres))
+
+    def __len__(self):
+        return len(self.names)
+
+    def genre(self, position: int) -> MusicBrainzGenre:
+        return MusicBrainzGenre(name=self.names[position], is_genre=bool(self.is_genre[position]),
+                                tag_count=self.tag_counts[position], processed_name=self.processed_names[position])
+
+    def match(self, genre: ServiceGenre) -> List[MatchResult]:
+        """
+        Find all tags that match `genre` with a ratio of 100.
+        Matches are in the order of the tags, and for a single tag in the order
+        subgenre, exact, parent, full, tokensort
+        """
+        found = []
+        if genre.subgenre:
+            for position in _lookup_positions(self.by_processed_name, genre.processed_subgenre):
+                found.append((position, 0, MatchType.SUBGENRE))
+            for position in _lookup_positions(self.by_lowercase_name, genre.lowercase_subgenre):
+                found.append((position, 1, MatchType.EXACT))
+        for position in _lookup_positions(self.by_processed_name, genre.processed_parent_genre):
+            found.append((position, 2, MatchType.PARENTGENRE))
+        for position in _lookup_positions(self.by_processed_name, genre.processed_full_genre):
+            found.append((position, 3, MatchType.FULLGENRE))
+        for position in _lookup_positions(self.by_sorted_tokens, sorted_tokens(genre.processed_full_genre_words)):
+            found.append((position, 4, MatchType.TOKENSORT))
+        found.sort(key=lambda f: (f[0], f[1]))
+        genres = {position: self.genre(position) for position, _, _ in found}
+        return [MatchResult(musicbrainz=genres[position], match=100, match_type=match_type)
+                for position, _, match_type in found]
+
+    def build_fuzzy_index(self):
+        """
+        Build the tables used by `fuzzy_match`: the distinct processed names grouped by length,
+        and for each length an inverted list from character n-gram to the names that contain it.
+        """
+        self.names_by_length: Dict[int, List[str]] = collections.defaultdict(list)
+        self.ngrams_by_length: Dict[int, Dict[str, List[int]]] = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        for name in self.by_processed_name:
+            if not name:
+                continue
+            names = self.names_by_length[len(name)]
+            grams = self.ngrams_by_length[len(name)]
+            for gram in ngrams(name):
+                grams[gram].append(len(names))
+            names.append(name)
+        self.names_by_length = dict(self.names_by_length)
+        self.ngrams_by_length = {length: dict(grams) for length, grams in self.ngrams_by_length.items()}
+
+    def fuzzy_candidates(self, name: str, min_ratio: int) -> List[str]:
+        """
+        Processed names which could have a fuzz.ratio with `name` of at least `min_ratio`.
+        fuzz.ratio is 100 * (1 - d / (len(a) + len(b))) where d is the number of insertions and deletions
+        needed to turn one string into the other. This bounds the length of a candidate, and because
+        an insertion or deletion changes at most NGRAM_SIZE n-grams, the number of n-grams it shares with `name`.
+        """
+        if not hasattr(self, "ngrams_by_length"):
+            self.build_fuzzy_index()
+        # ratios are rounded, allow for that
+        max_distance_fraction = (100.5 - min_ratio) / 100
+        if max_distance_fraction >= 1:
+            # Everything is a candidate
+            return [n for names in self.names_by_length.values() for n in names]
+        shortest = math.ceil(len(name) * (1 - max_distance_fraction) / (1 + max_distance_fraction))
+        longest = math.floor(len(name) * (1 + max_distance_fraction) / (1 - max_distance_fraction))
+        query_grams = set(ngrams(name))
+
+        candidates = []
+        for length in range(shortest, longest + 1):
+            names = self.names_by_length.get(length)
+            if not names:
+                continue
+            max_distance = math.floor(max_distance_fraction * (len(name) + length))
+            if abs(len(name) - length) > max_distance:
+                continue
+            min_shared = max(len(name), length) - NGRAM_SIZE + 1 - NGRAM_SIZE * max_distance
+            if min_shared <= 0:
+                candidates.extend(names)
+                continue
+            grams = self.ngrams_by_length[length]
+            shared = collections.Counter()
+            for gram in query_grams:
+                shared.update(grams.get(gram, []))
+            candidates.extend(names[i] for i, count in shared.items() if count >= min_shared)
+        return candidates
+
+    def fuzzy_match(self, genre: ServiceGenre, min_ratio: int, top_k: int) -> List[MatchResult]:
+        """
+        Find tags that are a near miss for the parent genre, subgenre, or full genre.
+        Processed names that are identical are already found by `match`, so aren't included here.
+        For each of these, return at most `top_k` tags with a ratio of at least `min_ratio`. Many tags can have the
+        same processed name (e.g. drum'n'bass and drum´n bass), so only the best tag for each processed name is
+        returned, preferring a genre and then the tag with the most uses
+        """
+        to_match = [(genre.processed_parent_genre, MatchType.FUZZY_PARENTGENRE)]
+        if genre.subgenre:
+            to_match.append((genre.processed_subgenre, MatchType.FUZZY_SUBGENRE))
+            to_match.append((genre.processed_full_genre, MatchType.FUZZY_FULLGENRE))
+
+        ret = []
+        for name, match_type in to_match:
+            if not name:
+                continue
+            matches = []
+            for candidate in self.fuzzy_candidates(name, min_ratio):
+                if candidate == name:
+                    continue
+                ratio = fuzz.ratio(candidate, name)
+                if ratio >= min_ratio:
+                    position = max(_lookup_positions(self.by_processed_name, candidate),
+                                   key=lambda p: (self.is_genre[p], self.tag_counts[p], self.names[p]))
+                    matches.append(MatchResult(musicbrainz=self.genre(position), match=ratio, match_type=match_type))
+            matches.sort(key=lambda x: (x.match, x.musicbrainz.is_genre, x.musicbrainz.name), reverse=True)
+            ret.extend(matches[:top_k])
+        return ret
+
+
+class Metrics:
+    """Timings and counts for a run, which can be written to a json file (main.py --metrics)"""
+
+    def __init__(self):
+        # seconds spent in each stage, in the order that they ran
+        self.stages = {}
+        # number of genres, tags, matches of each type, ...
+        self.counts = {}
+        # for each chunk of genres that was matched: the process that matched it, how many genres it had,
+        # how long it waited for a worker to start it, and how long it took
+        self.chunks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def add_chunk(self, pid: int, num_genres: int, wait_seconds: float, seconds: float):
+        self.chunks.append({"pid": pid, "genres": num_genres, "wait_seconds": wait_seconds, "seconds": seconds})
+
+    def write(self, path):
+        workers = collections.defaultdict(lambda: {"chunks": 0, "genres": 0, "seconds": 0.0})
+        for chunk in self.chunks:
+            worker = workers[chunk["pid"]]
+            worker["chunks"] += 1
+            worker["genres"] += chunk["genres"]
+            worker["seconds"] += chunk["seconds"]
+        metrics = {
+            "stages": self.stages,
+            "total_seconds": sum(self.stages.values()),
+            "counts": self.counts,
+            "workers": {str(pid): worker for pid, worker in workers.items()},
+            "chunks": self.chunks,
+        }
+        with open(path, "w") as fp:
+            json.dump(metrics, fp, indent=2)
+
+
+def count_matches(genre_matches: Dict[ServiceGenre, List[MatchResult]]) -> Dict:
+    """How many matches of each type were found, how many genres had at least one match of each type,
+    and how many genres were manually mapped, or didn't get any tags"""
+    match_types = collections.Counter()
+    genres_with_match_type = collections.Counter()
+    manual = 0
+    unmatched = 0
+    for dataset_genre, matches in genre_matches.items():
+        types = [match.match_type.name.lower() for match in matches]
+        match_types.update(types)
+        genres_with_match_type.update(set(types))
+        if any(match.match_type == MatchType.MANUAL for match in matches):
+            manual += 1
+        if not get_output_tags(dataset_genre, matches):
+            unmatched += 1
+    return {
+        "genres": len(genre_matches),
+        "match_types": dict(match_types),
+        "genres_with_match_type": dict(genres_with_match_type),
+        "manual": manual,
+        "unmatched": unmatched,
+    }
+
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):
         yield l[i:i + n]
 
 
-def threaded_match_genres(data_genres, musicbrainz_genres, manual_mapping) -> Dict[ServiceGenre, List[MatchResult]]:
-    num_workers = 12
-    chunk_size = math.ceil(len(data_genres) / num_workers)
+def load_musicbrainz_genres(genrefile, indexfile=None) -> MusicBrainzGenreIndex:
+    """Load the tags in a musicbrainz tag csv, using (and if needed, building) its tag index"""
+    return MusicBrainzGenreIndex.from_tag_index(tag_index.load_tag_index(genrefile, indexfile))
+
+
+# Set in each worker process by _init_worker, so that the tags are sent to a worker once instead of with every chunk
+_worker_args = None
+
+
+def _init_worker(mb_index, manual_mapping, min_ratio, top_k):
+    global _worker_args
+    _worker_args = (mb_index, manual_mapping, min_ratio, top_k)
+
+
+def _compare_in_worker(genre_chunk, submitted_at: float):
+    """Match a chunk of genres, and also return the pid of the worker, how long the chunk waited before it was
+    started, and how long it took"""
+    start = time.time()
+    result = compare(genre_chunk, *_worker_args)
+    return result, os.getpid(), start - submitted_at, time.time() - start
+
+
+def threaded_match_genres(data_genres, musicbrainz_genres, manual_mapping, min_ratio=None, top_k=3,
+                          num_workers=None, metrics: Optional[Metrics] = None) -> Dict[ServiceGenre, List[MatchResult]]:
+    if not data_genres:
+        return {}
+    if num_workers is None:
+        num_workers = datafiles.default_num_workers()
+    if isinstance(musicbrainz_genres, MusicBrainzGenreIndex):
+        mb_index = musicbrainz_genres
+    else:
+        mb_index = MusicBrainzGenreIndex.from_genres(musicbrainz_genres)
+    if min_ratio is not None and not hasattr(mb_index, "ngrams_by_length"):
+        # Build it before the index is sent to the workers, so that it's only built once
+        mb_index.build_fuzzy_index()
+
+    serial_threshold = SERIAL_THRESHOLD if min_ratio is None else SERIAL_THRESHOLD_FUZZY
+    if num_workers <= 1 or len(data_genres) < serial_threshold:
+        start = time.time()
+        genre_matches = compare(data_genres, mb_index, manual_mapping, min_ratio, top_k)
+        if metrics:
+            metrics.add_chunk(os.getpid(), len(data_genres), 0.0, time.time() - start)
+        return genre_matches
+
+    # Many small chunks, so that a worker that finishes early can pick up more work
+    chunk_size = max(1, min(MAX_CHUNK_SIZE, math.ceil(len(data_genres) / (num_workers * CHUNKS_PER_WORKER))))
     genre_matches = {}
-    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker,
+                                                initargs=(mb_index, manual_mapping, min_ratio, top_k)) as executor:
         futures = []
         for genre_chunk in chunks(data_genres, chunk_size):
-            futures.append(executor.submit(compare, genre_chunk, musicbrainz_genres, manual_mapping))
+            futures.append(executor.submit(_compare_in_worker, genre_chunk, time.time()))
 
         for future in concurrent.futures.as_completed(futures):
-            genre_matches.update(future.result())
+            result, pid, wait_seconds, seconds = future.result()
+            genre_matches.update(result)
+            if metrics:
+                metrics.add_chunk(pid, len(result), wait_seconds, seconds)
+    return genre_matches
+
+
+def _genre_key(genre: ServiceGenre) -> match_cache.GenreKey:
+    return genre.parent_genre, genre.subgenre or ""
+
+
+def _encode_matches(matches: List[MatchResult]) -> list:
+    return [[m.musicbrainz.name, m.musicbrainz.is_genre, m.musicbrainz.tag_count, m.match, m.match_type.name]
+            for m in matches]
+
+
+def _decode_matches(results: list) -> List[MatchResult]:
+    return [MatchResult(musicbrainz=MusicBrainzGenre(name=name, is_genre=is_genre, tag_count=tag_count), match=match,
+                        match_type=MatchType[match_type])
+            for name, is_genre, tag_count, match, match_type in results]
+
+
+def cached_match_genres(data_genres, mb_index: MusicBrainzGenreIndex, manual_mapping, genrefile, cache_file,
+                        min_ratio=None, top_k=3, num_workers=None,
+                        metrics: Optional[Metrics] = None) -> Dict[ServiceGenre, List[MatchResult]]:
+    """Like threaded_match_genres, but use the results in a match cache (see match_cache.py) for genres that
+    can't have a different result since they were cached, and add the results for the other genres to it"""
+    cache = match_cache.MatchCache(cache_file)
+    try:
+        cache.use_settings(min_ratio=min_ratio, top_k=top_k)
+        stale = []
+        if cache.tags_changed(genrefile):
+            fingerprints = {name: f"{is_genre},{tag_count}"
+                            for name, is_genre, tag_count in zip(mb_index.names, mb_index.is_genre, mb_index.tag_counts)}
+            cached_genres = cache.genres()
+            changed = cache.changed_tags(fingerprints) if cached_genres else []
+            if changed:
+                # A genre can only have a different result if it matches a tag that was added, removed, or changed
+                changed_index = MusicBrainzGenreIndex.from_genres(
+                    [MusicBrainzGenre(name=name, is_genre=False, tag_count=0) for name in changed])
+                for parent_genre, subgenre in cached_genres:
+                    genre = ServiceGenre(parent_genre=parent_genre, subgenre=subgenre or None, number_taggings=0)
+                    if changed_index.match(genre) or \
+                            (min_ratio is not None and changed_index.fuzzy_match(genre, min_ratio, 1)):
+                        stale.append((parent_genre, subgenre))
+            cache.update_tags(genrefile, fingerprints, stale)
+
+        # Manually mapped genres aren't cached, because looking them up in the mapping is quicker
+        manual_genres = [genre for genre in data_genres if genre.full_genre in manual_mapping]
+        genre_matches = compare(manual_genres, mb_index, manual_mapping)
+        other_genres = [genre for genre in data_genres if genre.full_genre not in manual_mapping]
+        cached = cache.get(_genre_key(genre) for genre in other_genres)
+        to_match = []
+        for genre in other_genres:
+            results = cached.get(_genre_key(genre))
+            if results is None:
+                to_match.append(genre)
+            else:
+                genre_matches[genre] = _decode_matches(results)
+
+        new_matches = threaded_match_genres(to_match, mb_index, manual_mapping, min_ratio, top_k, num_workers, metrics)
+        genre_matches.update(new_matches)
+        cache.add({_genre_key(genre): _encode_matches(matches) for genre, matches in new_matches.items()})
+    finally:
+        cache.close()
+    if metrics:
+        metrics.counts["match_cache"] = {"cached": len(cached), "matched": len(to_match), "stale": len(stale)}
     return genre_matches
 
 
-def compare(genre_chunk: List[ServiceGenre], musicbrainz_genres: List[MusicBrainzGenre], manual_mapping):
+def match_genres(genres: Sequence[Union[str, ServiceGenre]], mb_index: MusicBrainzGenreIndex, manual_mapping=None,
+                 min_ratio=None, top_k=3, num_workers=None, match_cache_file=None, genrefile=None,
+                 metrics: Optional[Metrics] = None) -> Dict[ServiceGenre, List[MatchResult]]:
+    """
+    Match genres to musicbrainz tags
+    :param genres: genres as in the data files ("parent---subgenre" or "parent"), or ServiceGenres
+    :param mb_index: index of musicbrainz tags, from load_musicbrainz_genres
+    :param manual_mapping: from load_manual_mapping
+    :param min_ratio: if set, also find near misses with at least this ratio
+    :param top_k: the maximum number of near misses for each of parent, subgenre, and full genre
+    :param num_workers: number of worker processes (default: the number of CPUs)
+    :param match_cache_file: if set, use and update this match cache. genrefile must also be set
+    :param genrefile: the musicbrainz tag csv that mb_index was loaded from
+    :return: dict of {service_genre: list of MatchResult}. Use get_output_row or get_output_tags to choose the tags
+    """
+    if manual_mapping is None:
+        manual_mapping = collections.defaultdict(list)
+    genres = [parse_service_genre(genre, 0) if isinstance(genre, str) else genre for genre in genres]
+    if match_cache_file:
+        if genrefile is None:
+            raise ValueError("genrefile is needed to use a match cache")
+        return cached_match_genres(genres, mb_index, manual_mapping, genrefile, match_cache_file, min_ratio, top_k,
+                                   num_workers, metrics)
+    return threaded_match_genres(genres, mb_index, manual_mapping, min_ratio, top_k, num_workers, metrics)
+
+
+def match_key(genre: ServiceGenre) -> tuple:
+    """The processed forms of a genre that matching uses. Genres with the same key (e.g. "hip hop" and "Hip-Hop")
+    always match the same tags"""
+    return (genre.processed_parent_genre, genre.processed_subgenre, genre.lowercase_subgenre,
+            genre.processed_full_genre, genre.processed_full_genre_words)
+
+
+def match_sources(sources: Sequence[Tuple[List[ServiceGenre], Dict[str, List[MusicBrainzGenre]]]],
+                  mb_index: MusicBrainzGenreIndex, min_ratio=None, top_k=3, num_workers=None, match_cache_file=None,
+                  genrefile=None, metrics: Optional[Metrics] = None) -> List[Dict[ServiceGenre, List[MatchResult]]]:
+    """
+    Match the genres of several sources, matching each distinct genre only once even if it's in more than one source
+    :param sources: (genres, manual mapping) for each source. The manual mapping of a source only applies to its genres
+    :return: the matches for each source, as returned by match_genres
+    """
+    # One genre for each match key that isn't manually mapped in the source that it's in
+    to_match = {}
+    for data_genres, manual_mapping in sources:
+        for genre in data_genres:
+            if genre.full_genre not in manual_mapping:
+                to_match.setdefault(match_key(genre), genre)
+    matches_by_key = {match_key(genre): matches
+                      for genre, matches in match_genres(list(to_match.values()), mb_index, None, min_ratio, top_k,
+                                                         num_workers, match_cache_file, genrefile, metrics).items()}
+    if metrics:
+        metrics.counts["distinct_genres"] = len(to_match)
+
+    results = []
+    for data_genres, manual_mapping in sources:
+        genre_matches = compare([genre for genre in data_genres if genre.full_genre in manual_mapping], mb_index,
+                                manual_mapping)
+        results.append({genre: genre_matches[genre] if genre in genre_matches else matches_by_key[match_key(genre)]
+                        for genre in data_genres})
+    return results
+
+
+def compare(genre_chunk: List[ServiceGenre], mb_index: MusicBrainzGenreIndex, manual_mapping,
+            min_ratio: Optional[int] = None, top_k: int = 3):
     """
     Try and find a matching musicbrainz
     :param manual_mapping:
     :param genre_chunk:
-    :param musicbrainz_genres:
+    :param mb_index: index of musicbrainz tags
+    :param min_ratio: if set, also find near misses with at least this ratio
+    :param top_k: the maximum number of near misses for each of parent, subgenre, and full genre
     :return: dict of {service_genre: list of (match ratio, mb tag)}
     """
 
@@ -131,145 +616,228 @@ def compare(genre_chunk: List[ServiceGenre], musicbrainz_genres: List[MusicBrain
             ret[genre] = matches
             continue
 
-        for mbg in musicbrainz_genres:
-            if DEBUG:
-                if mbg.name == "abstract electronic" and genre.subgenre == "abstract":
-                    print("abstract electronic")
-                    print(f"{mbg.processed_name_words}, {genre.processed_full_genre_words}")
-                    print(fuzz.token_sort_ratio(mbg.processed_name_words, genre.processed_full_genre_words))
-            if genre.subgenre:
-                ratio = fuzz.ratio(mbg.processed_name, genre.processed_subgenre)
-                if ratio == 100:
-                    matches.append(
-                        MatchResult(musicbrainz=mbg, match=ratio, match_type=MatchType.SUBGENRE)
-                    )
-                if mbg.name.lower() == genre.lowercase_subgenre:
-                    matches.append(
-                        MatchResult(musicbrainz=mbg, match=100, match_type=MatchType.EXACT)
-                    )
-            ratio = fuzz.ratio(mbg.processed_name, genre.processed_parent_genre)
-            if ratio == 100:
-                matches.append(
-                    MatchResult(musicbrainz=mbg, match=ratio, match_type=MatchType.PARENTGENRE)
-                )
-
-            ratio = fuzz.ratio(mbg.processed_name, genre.processed_full_genre)
-            if ratio == 100:
-                matches.append(
-                    MatchResult(musicbrainz=mbg, match=ratio, match_type=MatchType.FULLGENRE)
-                )
-            ratio = fuzz.token_sort_ratio(mbg.processed_name_words, genre.processed_full_genre_words)
-            if ratio == 100:
-                matches.append(
-                    MatchResult(musicbrainz=mbg, match=ratio, match_type=MatchType.TOKENSORT)
-                )
-        matches = sorted(matches, key=lambda m: m.match, reverse=True)
+        matches = mb_index.match(genre)
+        if min_ratio is not None:
+            matches += mb_index.fuzzy_match(genre, min_ratio, top_k)
         ret[genre] = matches
     return ret
 
 
-def main(genrefile, datafile, mappingfile=None, outfile=None):
-    mb_genres: List[MusicBrainzGenre] = []
-    with open(genrefile) as fp:
-        reader = csv.DictReader(fp)
-        for line in list(reader):
-            mbg = MusicBrainzGenre(name=line["name"], is_genre=line["has_genre"] == 't', tag_count=line["ref_count"])
-            mb_genres.append(mbg)
-
-
+def load_manual_mapping(mappingfile) -> Dict[str, List[MusicBrainzGenre]]:
+    """Load a manual mapping file, with rows genre,subgenre,tag1,tag2,..."""
     manual_mapping = collections.defaultdict(list)
-    if mappingfile:
-        with open(mappingfile) as fp:
-            r = csv.reader(fp)
-            for line in r:
-                genre = line[0]
-                subg = line[1]
-                if subg:
-                    genre = f"{genre}/{subg}"
-                maps = line[2:]
-                manual_mapping[genre] = [MusicBrainzGenre(name=m, is_genre='?', tag_count=0) for m in maps]
-
-    print(f"got {len(mb_genres)} genres")
+    with open(mappingfile) as fp:
+        r = csv.reader(fp)
+        for line in r:
+            genre = line[0]
+            subg = line[1]
+            if subg:
+                genre = f"{genre}/{subg}"
+            maps = line[2:]
+            manual_mapping[genre] = [MusicBrainzGenre(name=m, is_genre='?', tag_count=0) for m in maps]
+    return manual_mapping
+
+
+def parse_service_genre(genre: str, count: int) -> ServiceGenre:
+    # genres are either parent---subgenre, or just a main genre
+    if '---' in genre:
+        parent_genre, subgenre = genre.split('---')
+    else:
+        parent_genre, subgenre = genre, None
+    return ServiceGenre(parent_genre=parent_genre, subgenre=subgenre, number_taggings=count)
+
 
+def load_data_genres(datafile) -> List[ServiceGenre]:
+    """Load a list of genres and counts made by datafile-to-genrelist.py"""
     data_genres = []
     with open(datafile) as fp:
         reader = csv.DictReader(fp)
         for line in reader:
-            genre = line["genre"]
-            # genres are either parent---subgenre, or just a main genre
-            if '---' in genre:
-                parent_genre, subgenre = genre.split('---')
-            else:
-                parent_genre, subgenre = genre, None
-            data_genres.append(
-                ServiceGenre(parent_genre=parent_genre, subgenre=subgenre, number_taggings=int(line["count"])))
+            data_genres.append(parse_service_genre(line["genre"], int(line["count"])))
+    return data_genres
+
+
+class SelectedMatches(NamedTuple):
+    subgenrematch: Optional[MatchResult]
+    exactmatch: Optional[MatchResult]
+    fullmatch: Optional[MatchResult]
+    parentmatch: Optional[MatchResult]
+    tokenmatch: Optional[MatchResult]
+    mappings: List[MatchResult]
+    # Near misses, only for the parts of the genre that we didn't find anything for
+    fuzzy_matches: List[MatchResult]
+
+
+def select_matches(matches: List[MatchResult]) -> SelectedMatches:
+    """Choose the best match of each type for a genre"""
+    subgenrematch = get_match_for_matchtype(matches, MatchType.SUBGENRE)
+    exactmatch = get_match_for_matchtype(matches, MatchType.EXACT)
+    fullmatch = get_match_for_matchtype(matches, MatchType.FULLGENRE)
+    parentmatch = get_match_for_matchtype(matches, MatchType.PARENTGENRE)
+    tokenmatch = get_match_for_matchtype(matches, MatchType.TOKENSORT)
+    mappings = [match for match in matches if match.match_type == MatchType.MANUAL]
+    fuzzy_parent_matches = []
+    if not parentmatch:
+        fuzzy_parent_matches = [match for match in matches if match.match_type == MatchType.FUZZY_PARENTGENRE]
+    fuzzy_sub_matches = []
+    if not (subgenrematch or exactmatch or fullmatch or tokenmatch):
+        fuzzy_sub_matches = [match for match in matches
+                             if match.match_type in (MatchType.FUZZY_SUBGENRE, MatchType.FUZZY_FULLGENRE)]
+    return SelectedMatches(subgenrematch, exactmatch, fullmatch, parentmatch, tokenmatch, mappings,
+                           fuzzy_parent_matches + fuzzy_sub_matches)
+
+
+def print_genre_matches(dataset_genre: ServiceGenre, matches: List[MatchResult]):
+    print(f"* {dataset_genre.full_genre} (#{dataset_genre.number_taggings})")
+    if DEBUG:
+        for match in matches:
+            print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
+        print("----------")
+    selected = select_matches(matches)
+
+    if selected.mappings:
+        for match in selected.mappings:
+            print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
+    else:
+        for match in [selected.subgenrematch, selected.exactmatch, selected.fullmatch, selected.parentmatch]:
+            if match:
+                if match.match == 100:
+                    print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
+
+        # If this is the same match as the FULLGENRE match, don't show it
+        tokenmatch, fullmatch = selected.tokenmatch, selected.fullmatch
+        if tokenmatch:
+            if fullmatch is not None and tokenmatch.musicbrainz.name != fullmatch.musicbrainz.name and tokenmatch.match == 100:
+                print(
+                    f"    {tokenmatch.musicbrainz.name} g={tokenmatch.musicbrainz.is_genre} t={tokenmatch.match_type}")
+
+        for match in selected.fuzzy_matches:
+            print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type} r={match.match}")
+
+
+def get_output_row(dataset_genre: ServiceGenre, matches: List[MatchResult]) -> List[str]:
+    """The row of the output csv for a genre: parent genre, subgenre, then groups of mb tag, type, genre?"""
+    selected = select_matches(matches)
+    sub = dataset_genre.subgenre
+    parentmatch = selected.parentmatch
+    row = [dataset_genre.parent_genre, sub if sub else ""]
+    if selected.mappings:
+        for m in selected.mappings:
+            row += [m.musicbrainz.name, "manual", ""]
+    elif not sub and parentmatch and parentmatch.musicbrainz.is_genre:
+        # If there is no subgenre then only match the parent (if it's a genre)
+        row += [parentmatch.musicbrainz.name, "parent", ""]
+    else:
+        row += get_ordered_list_of_matches(selected.subgenrematch,
+                                           selected.exactmatch,
+                                           parentmatch,
+                                           selected.fullmatch, selected.tokenmatch)
+    if not selected.mappings:
+        row += get_list_of_fuzzy_matches(selected.fuzzy_matches, row[2::3])
+    return row
 
-    print(f"got {len(data_genres)} items from the datafile")
 
-    t = time.monotonic()
-    genre_matches = threaded_match_genres(data_genres, mb_genres, manual_mapping)
-    e = time.monotonic()
-    print(e - t)
+def get_output_tags(dataset_genre: ServiceGenre, matches: List[MatchResult]) -> List[str]:
+    """Just the musicbrainz tags from the output row for a genre, which are what we submit for it"""
+    return generate_mb_tags_for_source.row_tags(get_output_row(dataset_genre, matches))
 
-    print(f"{len(genre_matches)} matches")
 
+def write_output(genre_matches: Dict[ServiceGenre, List[MatchResult]], fp, verbose=True):
+    """Write the matches for each genre to a csv file, and if verbose, print them"""
     w = None
-    fp = None
-    if outfile == "-":
-        fp = sys.stdout
-    elif outfile:
-        fp = open(outfile, "w")
     if fp:
         w = csv.writer(fp)
-        w.writerow(["source parent genre", "source subgenre"] + ["mb tag", "type", "genre?"] * 4)
+        w.writerow(OUTPUT_HEADER)
 
     sorted_matches = sorted(genre_matches.items(), key=lambda x: x[0].full_genre)
     for dataset_genre, matches in sorted_matches:
-        print(f"* {dataset_genre.full_genre} (#{dataset_genre.number_taggings})")
-        if DEBUG:
-            for match in matches:
-                print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
-            print("----------")
-        subgenrematch = get_match_for_matchtype(matches, MatchType.SUBGENRE)
-        exactmatch = get_match_for_matchtype(matches, MatchType.EXACT)
-        fullmatch = get_match_for_matchtype(matches, MatchType.FULLGENRE)
-        parentmatch = get_match_for_matchtype(matches, MatchType.PARENTGENRE)
-        tokenmatch = get_match_for_matchtype(matches, MatchType.TOKENSORT)
-        mappings = [match for match in matches if match.match_type == MatchType.MANUAL]
-
-        if mappings:
-            for match in mappings:
-                print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
-        else:
-            for match in [subgenrematch, exactmatch, fullmatch, parentmatch]:
-                if match:
-                    if match.match == 100:
-                        print(f"    {match.musicbrainz.name} g={match.musicbrainz.is_genre} t={match.match_type}")
+        if verbose:
+            print_genre_matches(dataset_genre, matches)
+        if w:
+            w.writerow(get_output_row(dataset_genre, matches))
 
-            # If this is the same match as the FULLGENRE match, don't show it
-            if tokenmatch:
-                if fullmatch is not None and tokenmatch.musicbrainz.name != fullmatch.musicbrainz.name and tokenmatch.match == 100:
-                    print(
-                        f"    {tokenmatch.musicbrainz.name} g={tokenmatch.musicbrainz.is_genre} t={tokenmatch.match_type}")
 
-        if w:
-            sub = dataset_genre.subgenre
-            row = [dataset_genre.parent_genre, sub if sub else ""]
-            if mappings:
-                for m in mappings:
-                    row += [m.musicbrainz.name, "manual", ""]
-            elif not sub and parentmatch and parentmatch.musicbrainz.is_genre:
-                # If there is no subgenre then only match the parent (if it's a genre)
-                row += [parentmatch.musicbrainz.name, "parent", ""]
-            else:
-                row += get_ordered_list_of_matches(subgenrematch,
-                                                   exactmatch,
-                                                   parentmatch,
-                                                   fullmatch, tokenmatch)
-            w.writerow(row)
+def write_output_file(genre_matches: Dict[ServiceGenre, List[MatchResult]], outfile, verbose=True):
+    """write_output to a file, or to stdout if outfile is "-" """
+    if outfile == "-":
+        write_output(genre_matches, sys.stdout, verbose)
+    elif outfile:
+        with open(outfile, "w") as fp:
+            write_output(genre_matches, fp, verbose)
+    else:
+        write_output(genre_matches, None, verbose)
+
 
-    if fp and outfile != "-":
-        fp.close()
+def main(genrefile, datafile, mappingfile=None, outfile=None, min_ratio=None, top_k=3, indexfile=None,
+         num_workers=None, metrics_file=None, quiet=False, match_cache_file=None):
+    metrics = Metrics()
+    with metrics.stage("load_tags"):
+        mb_index = load_musicbrainz_genres(genrefile, indexfile)
+
+    manual_mapping = collections.defaultdict(list)
+    if mappingfile:
+        with metrics.stage("load_mapping"):
+            manual_mapping = load_manual_mapping(mappingfile)
+
+    print(f"got {len(mb_index)} genres")
+
+    with metrics.stage("load_genres"):
+        data_genres = load_data_genres(datafile)
+
+    print(f"got {len(data_genres)} items from the datafile")
+
+    with metrics.stage("match"):
+        genre_matches = match_genres(data_genres, mb_index, manual_mapping, min_ratio, top_k, num_workers,
+                                     match_cache_file, genrefile, metrics)
+    print(f"matched in {metrics.stages['match']:.2f}s")
+
+    print(f"{len(genre_matches)} matches")
+
+    with metrics.stage("output"):
+        write_output_file(genre_matches, outfile, verbose=not quiet)
+
+    if metrics_file:
+        metrics.counts.update(count_matches(genre_matches))
+        metrics.counts["tags"] = len(mb_index)
+        metrics.counts["manual_mappings"] = len(manual_mapping)
+        metrics.write(metrics_file)
+
+
+def main_sources(genrefile, sources: List[Tuple[str, Optional[str], Optional[str]]], min_ratio=None, top_k=3,
+                 indexfile=None, num_workers=None, metrics_file=None, quiet=False, match_cache_file=None):
+    """Like main, but for several sources at once, given as (datafile, mappingfile, outfile)"""
+    metrics = Metrics()
+    with metrics.stage("load_tags"):
+        mb_index = load_musicbrainz_genres(genrefile, indexfile)
+    print(f"got {len(mb_index)} genres")
+
+    loaded = []
+    for datafile, mappingfile, _ in sources:
+        manual_mapping = collections.defaultdict(list)
+        if mappingfile:
+            with metrics.stage("load_mapping"):
+                manual_mapping = load_manual_mapping(mappingfile)
+        with metrics.stage("load_genres"):
+            data_genres = load_data_genres(datafile)
+        print(f"got {len(data_genres)} items from {datafile}")
+        loaded.append((data_genres, manual_mapping))
+
+    with metrics.stage("match"):
+        results = match_sources(loaded, mb_index, min_ratio, top_k, num_workers, match_cache_file, genrefile,
+                                metrics)
+    print(f"matched in {metrics.stages['match']:.2f}s")
+
+    metrics.counts["sources"] = {}
+    for (datafile, _, outfile), (_, manual_mapping), genre_matches in zip(sources, loaded, results):
+        print(f"{datafile}: {len(genre_matches)} matches")
+        with metrics.stage("output"):
+            write_output_file(genre_matches, outfile, verbose=not quiet)
+        metrics.counts["sources"][datafile] = dict(count_matches(genre_matches),
+                                                   manual_mappings=len(manual_mapping))
+
+    if metrics_file:
+        metrics.counts["tags"] = len(mb_index)
+        metrics.write(metrics_file)
 
 
 def get_ordered_list_of_matches(subgenrematch: MatchResult, exactmatch: MatchResult, parentmatch: MatchResult,
@@ -286,22 +854,32 @@ def get_ordered_list_of_matches(subgenrematch: MatchResult, exactmatch: MatchRes
     # note that we prefer exact over subgenre match here
     # If we've seen the exact match before, or if we've seen something that looks similar after processing,
     # don't include it.
-    seen_matches = set()
+    seen_keys = set()
     for match, mt in [(exactmatch, "exact"), (subgenrematch, "subgenre"), (fullmatch, "full"), (tokenmatch, "unordered")]:
-        if match and not fuzzy_match_seen(seen_matches, match.musicbrainz.name):
+        if match and not fuzzy_match_seen(seen_keys, match.musicbrainz):
+            ret.extend([match.musicbrainz.name, mt, "" if match.musicbrainz.is_genre else "n"])
+            seen_keys.add(match.musicbrainz.processed_name)
+    return ret
+
+
+def get_list_of_fuzzy_matches(fuzzy_matches: List[MatchResult], existing_tags: List[str]):
+    """Near misses to add to the output, skipping tags that are already in the row"""
+    fuzzy_types = {MatchType.FUZZY_PARENTGENRE: "fuzzy parent",
+                   MatchType.FUZZY_SUBGENRE: "fuzzy subgenre",
+                   MatchType.FUZZY_FULLGENRE: "fuzzy full"}
+    ret = []
+    seen_matches = set(existing_tags)
+    for match in fuzzy_matches:
+        if match.musicbrainz.name not in seen_matches:
+            mt = f"{fuzzy_types[match.match_type]} {match.match}"
             ret.extend([match.musicbrainz.name, mt, "" if match.musicbrainz.is_genre else "n"])
             seen_matches.add(match.musicbrainz.name)
     return ret
 
 
-def fuzzy_match_seen(seen_matches: Set[str], match: str):
-    """See if a processed version of `match` appears as any element of seen_matches"""
-    processed_match = utils.full_process(match).replace(" ", "")
-    for sm in seen_matches:
-        processed_sm = utils.full_process(sm).replace(" ", "")
-        if processed_sm == processed_match:
-            return True
-    return False
+def fuzzy_match_seen(seen_keys: Set[str], match: MusicBrainzGenre):
+    """See if the processed name of `match` is in seen_keys, the processed names of the tags seen so far"""
+    return match.processed_name in seen_keys
 
 
 def get_match_for_matchtype(matches: List[MatchResult], matchtype: MatchType) -> Optional[MatchResult]:
@@ -317,7 +895,42 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', required=False)
     parser.add_argument('-m', required=False)
+    parser.add_argument('--fuzzy', action='store_true', help='Also suggest tags that are a near miss')
+    parser.add_argument('--min-ratio', type=int, default=85, help='Minimum ratio for a near miss (with --fuzzy)')
+    parser.add_argument('--top-k', type=int, default=3, help='Maximum near misses to suggest for each part of a genre')
+    parser.add_argument('-j', '--workers', type=int, required=False,
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--tag-index', required=False, help='Tag index file for genrefile (default <genrefile>.idx)')
+    parser.add_argument('--match-cache', required=False,
+                        help='Keep the matches in this file, and only match genres again if they could have changed')
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't print the matches for each genre")
+    parser.add_argument('--metrics', required=False,
+                        help='Write the time taken by each stage, and counts of each type of match, to this json file')
+    parser.add_argument('--profile', required=False,
+                        help='Profile the run with cProfile, and write the stats to this file (see pstats). '
+                             'Workers are not profiled, use -j 1 to include matching')
+    parser.add_argument('--source', nargs=3, action='append', metavar=('DATAFILE', 'MAPPING', 'OUTFILE'),
+                        help='Match the genres of several sources at once, instead of datafile. Use - for no '
+                             'mapping file. Can be given more than once')
     parser.add_argument('genrefile')
-    parser.add_argument('datafile')
+    parser.add_argument('datafile', nargs='?')
     args = parser.parse_args()
-    main(args.genrefile, args.datafile, args.m, args.o)
+    if bool(args.source) == bool(args.datafile):
+        parser.error("give either datafile or --source")
+    if args.source and (args.o or args.m):
+        parser.error("-o and -m can't be used with --source, give them for each source")
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.source:
+        sources = [(datafile, None if mappingfile == "-" else mappingfile, outfile)
+                   for datafile, mappingfile, outfile in args.source]
+        main_sources(args.genrefile, sources, args.min_ratio if args.fuzzy else None, args.top_k, args.tag_index,
+                     args.workers, args.metrics, args.quiet, args.match_cache)
+    else:
+        main(args.genrefile, args.datafile, args.m, args.o, args.min_ratio if args.fuzzy else None, args.top_k,
+             args.tag_index, args.workers, args.metrics, args.quiet, args.match_cache)
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
@@ -0,0 +1,92 @@
+# A cache of the tags that each genre matched, so that main.py only has to match the genres that could have a
+# different result since the last run (main.py --match-cache).
+#
+# Matching a genre against the tag list doesn't depend on the manual mapping, so the cache stores the results of
+# matching every genre that isn't manually mapped. Genres that are manually mapped are just looked up in the mapping,
+# so when the mapping changes, only the genres that are no longer in it may need to be matched.
+#
+# The cache also stores the tags that the results were matched against. When the tag list changes, only the genres
+# that match a tag that was added, removed, or changed have to be matched again (see main.cached_match_genres).
+
+import json
+import sqlite3
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import tag_index
+
+# Change this when a change to the matching means that cached results are no longer valid
+CACHE_VERSION = 1
+
+# parent genre, and subgenre or ""
+GenreKey = Tuple[str, str]
+
+
+class MatchCache:
+    """The results of matching genres to a tag list, stored in a sqlite database"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+            -- the tags that the cached results were matched against, and a fingerprint of their ref_count and is_genre
+            CREATE TABLE IF NOT EXISTS tags (name TEXT PRIMARY KEY, fingerprint TEXT) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS matches (parent_genre TEXT, subgenre TEXT, results TEXT,
+                                                PRIMARY KEY (parent_genre, subgenre)) WITHOUT ROWID;
+        """)
+
+    def _setting(self, key) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key, )).fetchone()
+        return row[0] if row else None
+
+    def _set_setting(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+    def use_settings(self, **settings):
+        """Remove everything from the cache if it was made with different settings (e.g. min_ratio)"""
+        value = json.dumps(dict(settings, version=CACHE_VERSION), sort_keys=True)
+        if self._setting("settings") != value:
+            with self.conn:
+                self.conn.execute("DELETE FROM tags")
+                self.conn.execute("DELETE FROM matches")
+                self.conn.execute("DELETE FROM settings")
+                self._set_setting("settings", value)
+
+    def tags_changed(self, genrefile: str) -> bool:
+        """If the tag list is different to the one that the cache was last updated with"""
+        return self._setting("tags_hash") != tag_index.csv_hash(genrefile).hex()
+
+    def changed_tags(self, fingerprints: Dict[str, str]) -> List[str]:
+        """The names of the tags that were added, removed, or have a different fingerprint"""
+        old = dict(self.conn.execute("SELECT name, fingerprint FROM tags"))
+        changed = [name for name, fingerprint in old.items() if fingerprints.get(name) != fingerprint]
+        changed += [name for name, fingerprint in fingerprints.items() if name not in old]
+        return changed
+
+    def update_tags(self, genrefile: str, fingerprints: Dict[str, str], stale: Iterable[GenreKey]):
+        """Store the tags that the cache is now up to date with, and remove the results that are out of date"""
+        with self.conn:
+            self.conn.executemany("DELETE FROM matches WHERE parent_genre = ? AND subgenre = ?", stale)
+            self.conn.execute("DELETE FROM tags")
+            self.conn.executemany("INSERT INTO tags (name, fingerprint) VALUES (?, ?)", fingerprints.items())
+            self._set_setting("tags_hash", tag_index.csv_hash(genrefile).hex())
+
+    def genres(self) -> List[GenreKey]:
+        return self.conn.execute("SELECT parent_genre, subgenre FROM matches").fetchall()
+
+    def get(self, keys: Iterable[GenreKey]) -> Dict[GenreKey, list]:
+        """The cached results for the genres that are in the cache"""
+        found = {}
+        for key in keys:
+            row = self.conn.execute("SELECT results FROM matches WHERE parent_genre = ? AND subgenre = ?",
+                                    key).fetchone()
+            if row:
+                found[key] = json.loads(row[0])
+        return found
+
+    def add(self, results: Dict[GenreKey, list]):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO matches (parent_genre, subgenre, results) VALUES (?, ?, ?)",
+                                  ((parent, sub, json.dumps(r)) for (parent, sub), r in results.items()))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,169 @@
+# Match genres to MusicBrainz tags on demand. The tag list and manual mapping are loaded once when the server
+# starts, so each lookup only takes as long as matching the genres, instead of the time to start main.py.
+#
+#   python match_server.py --socket /tmp/genre-matching.sock -m mapping/lastfm-mapping.csv mapping/mb_tags.csv
+#   python match_server.py --socket /tmp/genre-matching.sock --query "rock---blues rock" "electronic---drumnbass"
+#
+# The server listens on a unix socket (--socket) or on a tcp port (--port). Requests and responses are json
+# objects, one per line, and any number of requests can be sent on one connection. A request is a list of genres
+# in the same format as the data files:
+#   {"genres": ["rock---blues rock", "jazz"]}
+# and the response has a result for each genre, in the same order. The matches are the columns that main.py writes
+# to its output file for the genre (mb tag, type, genre?), and tags are the tags that would be submitted for it:
+#   {"results": [{"genre": "rock---blues rock", "matches": [["rock", "parent", ""], ["blues rock", "subgenre", ""]],
+#                 "tags": ["rock", "blues rock"]}, ...]}
+# If a request can't be read, the response is {"error": "..."}
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+from typing import Dict, List, Optional
+
+import generate_mb_tags_for_source
+import main as matching
+
+
+class GenreMatcher:
+    """A tag index and manual mapping that are kept loaded, to match genres one request at a time"""
+
+    def __init__(self, mb_index: matching.MusicBrainzGenreIndex, manual_mapping, min_ratio=None, top_k=3):
+        self.mb_index = mb_index
+        self.manual_mapping = manual_mapping
+        self.min_ratio = min_ratio
+        self.top_k = top_k
+        if min_ratio is not None:
+            mb_index.build_fuzzy_index()
+
+    @classmethod
+    def load(cls, genrefile, mappingfile=None, indexfile=None, min_ratio=None, top_k=3) -> "GenreMatcher":
+        mb_index = matching.load_musicbrainz_genres(genrefile, indexfile)
+        manual_mapping = None
+        if mappingfile:
+            manual_mapping = matching.load_manual_mapping(mappingfile)
+        return cls(mb_index, manual_mapping, min_ratio, top_k)
+
+    def lookup(self, genres: List[str]) -> List[Dict]:
+        """Match genres, and return a result for each of them"""
+        results = []
+        service_genres = []
+        for genre in genres:
+            try:
+                service_genres.append(matching.parse_service_genre(genre, 0))
+            except ValueError:
+                service_genres.append(None)
+        # Requests are small, so match them in this process instead of with workers
+        genre_matches = matching.match_genres([g for g in service_genres if g is not None], self.mb_index,
+                                              self.manual_mapping, self.min_ratio, self.top_k, num_workers=1)
+        for genre, service_genre in zip(genres, service_genres):
+            if service_genre is None:
+                results.append({"genre": genre, "error": "genres must be 'parent' or 'parent---subgenre'"})
+                continue
+            row = matching.get_output_row(service_genre, genre_matches[service_genre])
+            matches = [row[i:i + 3] for i in range(2, len(row), 3)]
+            results.append({"genre": genre, "matches": matches,
+                            "tags": generate_mb_tags_for_source.row_tags(row)})
+        return results
+
+
+def handle_request(matcher: GenreMatcher, line: bytes) -> Dict:
+    try:
+        request = json.loads(line)
+        genres = request["genres"]
+        if not isinstance(genres, list) or not all(isinstance(g, str) for g in genres):
+            raise ValueError
+    except (ValueError, KeyError, TypeError):
+        return {"error": 'requests must be a json object like {"genres": ["rock---blues rock"]}'}
+    # Matching is quick enough (well under a millisecond for each genre without --fuzzy) that it's done
+    # directly in the event loop instead of in a thread
+    return {"results": matcher.lookup(genres)}
+
+
+def remove_stale_socket(socket_path: str):
+    """Remove a socket left behind by a server that has stopped, but not one that a server is listening on"""
+    if not os.path.exists(socket_path):
+        return
+    try:
+        connect(socket_path).close()
+    except ConnectionRefusedError:
+        os.remove(socket_path)
+
+
+async def serve(matcher: GenreMatcher, socket_path: Optional[str] = None, host="localhost", port=None):
+    async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = handle_request(matcher, line)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if socket_path:
+        remove_stale_socket(socket_path)
+        server = await asyncio.start_unix_server(handle_connection, path=socket_path, limit=2 ** 24)
+    else:
+        server = await asyncio.start_server(handle_connection, host=host, port=port, limit=2 ** 24)
+    print(f"Listening on {socket_path or f'{host}:{port}'}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def connect(socket_path: Optional[str] = None, host="localhost", port=None) -> socket.socket:
+    if socket_path:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        return sock
+    return socket.create_connection((host, port))
+
+
+def query(genres: List[str], socket_path: Optional[str] = None, host="localhost", port=None) -> List[Dict]:
+    """Look up genres in a running server"""
+    with connect(socket_path, host, port) as sock, sock.makefile("rwb") as fp:
+        fp.write(json.dumps({"genres": genres}).encode() + b"\n")
+        fp.flush()
+        response = json.loads(fp.readline())
+    if "error" in response:
+        raise ValueError(response["error"])
+    return response["results"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required=False, help='Unix socket to listen on or connect to')
+    parser.add_argument('--host', default='localhost', help='Host to listen on or connect to (with --port)')
+    parser.add_argument('--port', type=int, required=False, help='TCP port to listen on or connect to')
+    parser.add_argument('--query', nargs='+', required=False,
+                        help='Instead of starting a server, look up these genres in a running server')
+    parser.add_argument('-m', required=False, help='Manual mapping file')
+    parser.add_argument('--fuzzy', action='store_true', help='Also suggest tags that are a near miss')
+    parser.add_argument('--min-ratio', type=int, default=85, help='Minimum ratio for a near miss (with --fuzzy)')
+    parser.add_argument('--top-k', type=int, default=3, help='Maximum near misses to suggest for each part of a genre')
+    parser.add_argument('--tag-index', required=False, help='Tag index file for genrefile (default <genrefile>.idx)')
+    parser.add_argument('genrefile', nargs='?')
+    args = parser.parse_args()
+    if not args.socket and not args.port:
+        parser.error("one of --socket or --port is needed")
+
+    if args.query:
+        for result in query(args.query, args.socket, args.host, args.port):
+            print(json.dumps(result))
+    else:
+        if not args.genrefile:
+            parser.error("genrefile is needed to start a server")
+        matcher = GenreMatcher.load(args.genrefile, args.m, args.tag_index, args.min_ratio if args.fuzzy else None,
+                                    args.top_k)
+        try:
+            asyncio.run(serve(matcher, args.socket, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if args.socket and os.path.exists(args.socket):
+                os.remove(args.socket)
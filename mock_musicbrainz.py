@@ -0,0 +1,141 @@
+# A local stand-in for the MusicBrainz tag submission endpoint (POST /ws/2/tag), for testing upload_tags.py
+# without sending anything to a real server.
+#
+#   python mock_musicbrainz.py --port 8080 --latency 0.2
+#   python upload_tags.py --server localhost:8080 rec lastfm-tags-to-submit.csv
+#
+# Like the real server, requests over the rate limit get a 503 response, and submissions with an invalid mbid a 400
+# response. Use --error-rate to also fail some requests with a 500 response.
+
+import argparse
+import random
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OK_RESPONSE = b'<?xml version="1.0" encoding="UTF-8"?>' \
+              b'<metadata xmlns="http://musicbrainz.org/ns/mmd-2.0#"><message><text>OK</text></message></metadata>'
+
+NS = "{http://musicbrainz.org/ns/mmd-2.0#}"
+
+
+def parse_tag_request(body: bytes):
+    """The recording mbids and tags in a tag submission, as {mbid: [tags]}"""
+    recordings = {}
+    for recording in ET.fromstring(body).iter(f"{NS}recording"):
+        mbid = recording.get(f"{NS}id") or recording.get("id")
+        recordings[mbid] = [name.text for name in recording.iter(f"{NS}name")]
+    return recordings
+
+
+def is_valid_mbid(mbid: str) -> bool:
+    try:
+        uuid.UUID(mbid)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+class MockMusicBrainz(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, rate_limit_requests=None, rate_limit_interval=1.0, error_rate=0.0):
+        super().__init__(address, MockMusicBrainzHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_requests = rate_limit_requests
+        self.rate_limit_interval = rate_limit_interval
+        self.lock = threading.Lock()
+        self.tokens = rate_limit_requests or 0
+        self.updated = time.monotonic()
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_errors = 0
+        # mbid: tags, for all accepted submissions
+        self.submitted = {}
+
+    def over_rate_limit(self) -> bool:
+        """Check the rate limit like a token bucket (the same way nginx does), allowing bursts of up to
+        rate_limit_requests requests. A small tolerance allows for requests that arrive a bit closer together
+        than they were sent"""
+        if not self.rate_limit_requests:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.rate_limit_requests,
+                              self.tokens + (now - self.updated) * self.rate_limit_requests / self.rate_limit_interval)
+            self.updated = now
+            if self.tokens < 0.9:
+                self.num_rate_limited += 1
+                return True
+            self.tokens -= 1
+            return False
+
+
+class MockMusicBrainzHandler(BaseHTTPRequestHandler):
+    server: MockMusicBrainz
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body=b""):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/xml; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.num_requests += 1
+        if not self.path.startswith("/ws/2/tag"):
+            self.send(404)
+            return
+        if self.server.over_rate_limit():
+            self.send(503)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        recordings = parse_tag_request(body)
+        if not all(is_valid_mbid(mbid) for mbid in recordings):
+            self.send(400)
+            return
+        if random.random() < self.server.error_rate:
+            with self.server.lock:
+                self.server.num_errors += 1
+            self.send(500)
+            return
+        with self.server.lock:
+            self.server.submitted.update(recordings)
+        self.send(200, OK_RESPONSE)
+
+
+def serve(port=8080, latency=0.0, rate_limit_requests=None, rate_limit_interval=1.0, error_rate=0.0) -> MockMusicBrainz:
+    """Start a mock server on a background thread, and return it. Use port 0 to pick a free port"""
+    server = MockMusicBrainz(("localhost", port), latency, rate_limit_requests, rate_limit_interval, error_rate)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before responding')
+    parser.add_argument('--rate-limit', type=int, required=False,
+                        help='Respond with 503 to more than this many requests per --rate-interval')
+    parser.add_argument('--rate-interval', type=float, default=1.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests to respond to with a 500 error')
+    args = parser.parse_args()
+    server = MockMusicBrainz(("localhost", args.port), args.latency, args.rate_limit, args.rate_interval,
+                             args.error_rate)
+    print(f"Listening on localhost:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"{server.num_requests} requests, {server.num_rate_limited} rate limited, {server.num_errors} errors, "
+              f"{len(server.submitted)} recordings submitted")
@@ -0,0 +1,66 @@
+# Normalization of tag and genre names, so that names that only differ in case, punctuation or spacing can be
+# matched. Names are processed with thefuzz's full_process (lowercase, a-z and 0-9 only, every other character replaced
+# with a space and leading and trailing spaces removed, so 'drum & bass' becomes 'drum   bass'), and matched either
+# with these spaces between the words, or with no spaces at all.
+#
+# The same names are normalized many times in a run (e.g. a tag that is matched by many genres, or a parent genre
+# that has many subgenres), so the results are kept in a bounded cache. Use normalize_all to normalize a whole column
+# of names at once (e.g. all tags in a tag list) without filling the cache with names that are only seen once.
+
+import functools
+from typing import Iterable, List, NamedTuple
+
+from thefuzz import utils
+
+# The number of names to keep in the cache of each process. This is more than the number of genres in any of
+# the data sources, but less than the number of tags in mb_tags.csv, which are normalized with normalize_all
+CACHE_SIZE = 1 << 16
+
+
+class Normalized(NamedTuple):
+    # a-z and 0-9, with a space for each other character between words (not collapsed into one)
+    words: str
+    # words, without the spaces
+    key: str
+
+
+def _normalize(name: str) -> Normalized:
+    words = utils.full_process(name)
+    return Normalized(words, words.replace(" ", ""))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def normalize(name: str) -> Normalized:
+    """The processed forms of a name"""
+    return _normalize(name)
+
+
+def _each_once(func, names: Iterable[str]) -> list:
+    seen = {}
+    ret = []
+    for name in names:
+        value = seen.get(name)
+        if value is None:
+            value = seen[name] = func(name)
+        ret.append(value)
+    return ret
+
+
+def normalize_all(names: Iterable[str]) -> List[Normalized]:
+    """The processed forms of each name in a list. Each distinct name is only processed once"""
+    return _each_once(_normalize, names)
+
+
+def _sorted_tokens(s: str) -> str:
+    return " ".join(sorted(utils.full_process(s, force_ascii=True).split()))
+
+
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def sorted_tokens(s: str) -> str:
+    """The key that fuzz.token_sort_ratio compares: ascii-only processed words, in sorted order"""
+    return _sorted_tokens(s)
+
+
+def sorted_tokens_all(strings: Iterable[str]) -> List[str]:
+    """sorted_tokens of each string in a list"""
+    return _each_once(_sorted_tokens, strings)
@@ -0,0 +1,130 @@
+# Run the whole process for a source in a single pass over its data files:
+#  1. count the genres used in the data files (datafile-to-genrelist.py)
+#  2. match each genre to MusicBrainz tags (main.py)
+#  3. write the MusicBrainz tags for each recording (generate_mb_tags_for_source.py)
+# While the genres are counted, the genres of each recording are kept in memory, so that once the genres
+# are matched they can be expanded to tags without reading the data files again.
+# The genre counts and matches are only written to a file if requested, e.g. to check the matches manually.
+#
+#   python pipeline.py -m mapping/lastfm-mapping.csv --matches lastfm-to-mb-tags.csv -o lastfm-tags-to-submit.csv \
+#       mapping/mb_tags.csv data/acousticbrainz-mediaeval-lastfm-*
+
+import argparse
+import array
+import collections
+import concurrent.futures
+import csv
+import io
+import sys
+from typing import Dict, List, NamedTuple, Tuple
+
+import datafiles
+import main as matching
+
+
+class ScannedChunk(NamedTuple):
+    # how many times each genre appears in the chunk
+    counts: collections.Counter
+    # each distinct set of genres that a recording in the chunk has
+    combinations: List[Tuple[str, ...]]
+    # the mbid of each recording, separated by newlines
+    mbids: str
+    # for each recording, the position of its genres in `combinations`
+    combination_ids: array.array
+
+
+def scan_chunk(chunk: datafiles.DataChunk) -> ScannedChunk:
+    """Count the genres in a chunk of a data file, and keep the genres of each recording"""
+    counts = collections.Counter()
+    combination_positions = {}
+    mbids = []
+    combination_ids = array.array("I")
+    for line in datafiles.read_rows(chunk):
+        genres = tuple(genre for genre in line[2:] if genre)
+        counts.update(genres)
+        mbids.append(line[0])
+        combination_ids.append(combination_positions.setdefault(genres, len(combination_positions)))
+    return ScannedChunk(counts, list(combination_positions), "\n".join(mbids), combination_ids)
+
+
+def expand_scanned_chunk(scanned: ScannedChunk, mapping_genre_to_tags: Dict[str, List[str]]) -> str:
+    """The musicbrainz tags for each recording in a scanned chunk, as csv"""
+    tags_for_combination = []
+    for genres in scanned.combinations:
+        mb_tags = set()
+        for genre in genres:
+            mb_tags.update(mapping_genre_to_tags[genre])
+        tags_for_combination.append(sorted(mb_tags))
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for mbid, combination_id in zip(scanned.mbids.split("\n"), scanned.combination_ids):
+        mb_tags = tags_for_combination[combination_id]
+        if mb_tags:
+            writer.writerow([mbid] + mb_tags)
+    return out.getvalue()
+
+
+def scan_datafiles(datafile_names: List[str], num_workers: int) -> List[ScannedChunk]:
+    chunks = (chunk for datafile in datafile_names for chunk in datafiles.iter_chunks(datafile))
+    if num_workers <= 1:
+        return [scan_chunk(chunk) for chunk in chunks]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return list(datafiles.imap_ordered(executor, scan_chunk, chunks, num_workers * 2))
+
+
+def main(genrefile, datafile_names, mappingfile=None, outfile=None, counts_file=None, matches_file=None,
+         indexfile=None, num_workers=None):
+    if num_workers is None:
+        num_workers = datafiles.default_num_workers()
+
+    scanned = scan_datafiles(datafile_names, num_workers)
+    data_genre_counts = collections.Counter()
+    for s in scanned:
+        data_genre_counts.update(s.counts)
+    print(f"got {len(data_genre_counts)} genres from {len(datafile_names)} datafiles", file=sys.stderr)
+
+    if counts_file:
+        with open(counts_file, "w") as fp:
+            writer = csv.DictWriter(fp, fieldnames=["genre", "count"])
+            writer.writeheader()
+            for genre, count in data_genre_counts.items():
+                writer.writerow({"genre": genre, "count": count})
+
+    mb_index = matching.load_musicbrainz_genres(genrefile, indexfile)
+    manual_mapping = collections.defaultdict(list)
+    if mappingfile:
+        manual_mapping = matching.load_manual_mapping(mappingfile)
+    data_genres = {genre: matching.parse_service_genre(genre, count) for genre, count in data_genre_counts.items()}
+    genre_matches = matching.threaded_match_genres(list(data_genres.values()), mb_index, manual_mapping,
+                                                   num_workers=num_workers)
+    print(f"matched {len(genre_matches)} genres to {len(mb_index)} musicbrainz tags", file=sys.stderr)
+
+    if matches_file:
+        with open(matches_file, "w") as fp:
+            matching.write_output(genre_matches, fp, verbose=False)
+
+    mapping_genre_to_tags = {genre: matching.get_output_tags(service_genre, genre_matches[service_genre])
+                             for genre, service_genre in data_genres.items()}
+    fp = open(outfile, "w") if outfile and outfile != "-" else sys.stdout
+    try:
+        for s in scanned:
+            fp.write(expand_scanned_chunk(s, mapping_genre_to_tags))
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', required=False, help='File to write the tags for each recording to (default stdout)')
+    parser.add_argument('-m', required=False, help='Manual mapping file')
+    parser.add_argument('--counts', required=False, help='Also write the genres and their counts to this file')
+    parser.add_argument('--matches', required=False, help='Also write the matches for each genre to this file')
+    parser.add_argument('-j', '--workers', type=int, required=False,
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--tag-index', required=False, help='Tag index file for genrefile (default <genrefile>.idx)')
+    parser.add_argument('genrefile')
+    parser.add_argument('datafile', nargs='+', help='Data file(s), optionally compressed with bzip2, gzip, or xz')
+    args = parser.parse_args()
+    main(args.genrefile, args.datafile, args.m, args.o, args.counts, args.matches, args.tag_index, args.workers)
@@ -1,55 +1,354 @@
+# Compare the genres used by different data files (sources): which subgenres are used under more than one parent
+# genre or source, how many genres each pair of sources share, which parent genres are used together on the same
+# recording, and, given the matches from main.py, how many tags each source would add.
+#
+#   python stats.py data/acousticbrainz-mediaeval-*-train.tsv.bz2
+#   python stats.py --matches lastfm lastfm-to-mb-tags.csv --matches discogs discogs-to-mb-tags.csv \
+#       --json stats.json --cache stats-cache.db data/acousticbrainz-mediaeval-*-train.tsv.bz2
+#
+# Files are split into chunks which are read in parallel. Each chunk is reduced to the number of recordings with
+# each list of genres, and everything else is worked out from those counts, which are much smaller than the file.
+# With --cache, the counts for each file are kept in a database, keyed by a hash of the file's contents, so a file
+# is only read again if it changes. Without --json, --cache or --matches only the genres that each file uses are
+# printed, so then each chunk is only reduced to the number of recordings with each genre, which is quicker.
+
 import argparse
+import array
 import collections
-import csv
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import os
+import sqlite3
+from typing import Dict, List, Optional, Set, Tuple
+
+import datafiles
+import generate_mb_tags_for_source
+
+# Change this when a change to count_genre_lists means that cached counts are no longer valid
+STATS_CACHE_VERSION = 1
+
+
+def source_name(datafile: str) -> str:
+    """The name of a data file without its directory or extensions"""
+    name = os.path.basename(datafile)
+    if datafiles.is_compressed(name):
+        name = os.path.splitext(name)[0]
+    return os.path.splitext(name)[0]
+
+
+def split_genre(genre: str) -> Tuple[str, Optional[str]]:
+    if '---' in genre:
+        parent, sub = genre.split('---')
+        return parent, sub
+    return genre, None
+
+
+def file_hash(datafile: str) -> str:
+    h = hashlib.sha256()
+    with open(datafile, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class StatsCache:
+    """
+    The genre list counts of data files, stored in a sqlite database keyed by a hash of each file.
+    Genre names are stored once for each file, and the genre lists as an array of
+    [count, number of genres, genre number, genre number, ...]
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS genre_lists (hash TEXT, version INTEGER, genres TEXT, "
+                          "counts BLOB, PRIMARY KEY (hash, version)) WITHOUT ROWID")
+        self.conn.commit()
+
+    def get(self, digest: str) -> Optional[collections.Counter]:
+        row = self.conn.execute("SELECT genres, counts FROM genre_lists WHERE hash = ? AND version = ?",
+                                (digest, STATS_CACHE_VERSION)).fetchone()
+        if row is None:
+            return None
+        genres = json.loads(row[0])
+        values = array.array("Q")
+        values.frombytes(row[1])
+        counts = collections.Counter()
+        position = 0
+        while position < len(values):
+            count, length = values[position], values[position + 1]
+            position += 2
+            counts[tuple(genres[g] for g in values[position:position + length])] = count
+            position += length
+        return counts
+
+    def add(self, digest: str, counts: collections.Counter):
+        numbers = {genre: i for i, genre in enumerate({genre: None for genres in counts for genre in genres})}
+        values = array.array("Q")
+        for genres, count in counts.items():
+            values.append(count)
+            values.append(len(genres))
+            values.extend(map(numbers.__getitem__, genres))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO genre_lists (hash, version, genres, counts) VALUES (?, ?, ?, ?)",
+                              (digest, STATS_CACHE_VERSION, json.dumps(list(numbers)), values.tobytes()))
+
+    def close(self):
+        self.conn.close()
+
+
+def count_genre_lists(chunk: datafiles.DataChunk) -> collections.Counter:
+    """How many recordings in a chunk of a data file have each list of genres. A genre is only in a list once"""
+    return collections.Counter(tuple(dict.fromkeys(filter(None, line[2:]))) for line in datafiles.read_rows(chunk))
+
+
+def count_genres(chunk: datafiles.DataChunk) -> collections.Counter:
+    """How many times each genre is used in a chunk of a data file. This is the number of recordings with the genre,
+    unless a recording lists the same genre more than once"""
+    counts = collections.Counter(itertools.chain.from_iterable(line[2:] for line in datafiles.read_rows(chunk)))
+    counts.pop("", None)
+    return counts
+
+
+def _count_chunk(chunk: datafiles.DataChunk, genre_lists=True):
+    return chunk.datafile, count_genre_lists(chunk) if genre_lists else count_genres(chunk)
+
+
+def count_files(datafile_names: List[str], num_workers: Optional[int] = None,
+                cache_file: Optional[str] = None, genre_lists=True) -> Dict[str, collections.Counter]:
+    """
+    Count the genre lists in each data file, reading the chunks of all files that aren't cached in parallel
+    :param genre_lists: if False, only count each genre (with count_genres), which is quicker. These counts
+                        can't be used by compute_stats, and aren't cached
+    """
+    if genre_lists is False:
+        cache_file = None
+    if num_workers is None:
+        num_workers = datafiles.default_num_workers()
+    file_counts = {}
+    cache = StatsCache(cache_file) if cache_file else None
+    digests = {}
+    to_read = []
+    try:
+        for datafile in datafile_names:
+            if cache:
+                digests[datafile] = file_hash(datafile)
+                counts = cache.get(digests[datafile])
+                if counts is not None:
+                    file_counts[datafile] = counts
+                    continue
+            file_counts[datafile] = collections.Counter()
+            to_read.append(datafile)
+
+        chunks = (chunk for f in to_read for chunk in datafiles.iter_chunks(f))
+        count_chunk = functools.partial(_count_chunk, genre_lists=genre_lists)
+        if num_workers <= 1:
+            for datafile, counts in map(count_chunk, chunks):
+                file_counts[datafile].update(counts)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+                for datafile, counts in datafiles.imap_ordered(executor, count_chunk, chunks, num_workers * 2):
+                    file_counts[datafile].update(counts)
+
+        if cache:
+            for datafile in to_read:
+                cache.add(digests[datafile], file_counts[datafile])
+    finally:
+        if cache:
+            cache.close()
+    return file_counts
+
+
+def genre_counts(genre_lists: collections.Counter) -> collections.Counter:
+    """The number of recordings with each genre"""
+    counts = {}
+    for genres, count in genre_lists.items():
+        for genre in genres:
+            counts[genre] = counts.get(genre, 0) + count
+    return collections.Counter(counts)
+
+
+def subgenres_by_parent(genres) -> Dict[str, Set[str]]:
+    """The subgenres of each parent genre in a list of genres"""
+    parents = collections.defaultdict(set)
+    for genre in genres:
+        parent, sub = split_genre(genre)
+        if sub:
+            parents[parent].add(sub)
+        else:
+            parents[parent]
+    return parents
 
 
-def load_genres(datafile):
-    genres = collections.defaultdict(set)
-    with open(datafile) as fp:
-        r = csv.reader(fp, dialect=csv.excel_tab)
-        next(r)
-        for line in r:
-            for genre in line[2:]:
-                if genre:
-                    if '---' in genre:
-                        parent, sub = genre.split('---')
-                        genres[parent].add(sub)
-                    else:
-                        if genre not in genres:
-                            genres[genre] = set()
-    return genres
-
-
-def main(files, debug):
-    filegenres = {}
+def load_genres(datafile, num_workers=None) -> Dict[str, Set[str]]:
+    """The subgenres of each parent genre in a data file"""
+    return subgenres_by_parent(count_files([datafile], num_workers, genre_lists=False)[datafile])
+
+
+def parent_cooccurrence(genre_lists: collections.Counter) -> collections.Counter:
+    """The number of recordings with each pair of different parent genres"""
+    # Many genre lists have the same parent genres, so count the pairs for each set of parents once
+    parent_of = {genre: split_genre(genre)[0] for genre in set(itertools.chain.from_iterable(genre_lists))}
+    parent_lists = {}
+    for genres, count in genre_lists.items():
+        parents = set(map(parent_of.__getitem__, genres))
+        if len(parents) > 1:
+            key = tuple(sorted(parents))
+            parent_lists[key] = parent_lists.get(key, 0) + count
+    counts = collections.Counter()
+    for parents, count in parent_lists.items():
+        for pair in itertools.combinations(parents, 2):
+            counts[pair] += count
+    return counts
+
+
+def most_common(counts: collections.Counter) -> List[Tuple]:
+    """Like Counter.most_common, but items with the same count are in sorted order, so that the output of stats.py
+    is always the same"""
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+def load_matches(matches_file: str) -> Dict[str, List[str]]:
+    """The tags for each genre in a file written by main.py"""
+    return generate_mb_tags_for_source.load_mapping(matches_file)
+
+
+def tag_volume(genre_lists: collections.Counter, mapping_genre_to_tags: Dict[str, List[str]]) -> Dict:
+    """How many tags generate_mb_tags_for_source.py would make for the recordings with these genres"""
+    tag_counts = collections.Counter()
+    recordings = tags = 0
+    unmapped = set()
+    for genres, count in genre_lists.items():
+        recording_tags = set()
+        for genre in genres:
+            if genre in mapping_genre_to_tags:
+                recording_tags.update(mapping_genre_to_tags[genre])
+            else:
+                unmapped.add(genre)
+        if recording_tags:
+            recordings += count
+            tags += len(recording_tags) * count
+            for tag in recording_tags:
+                tag_counts[tag] += count
+    return {"recordings_with_tags": recordings, "recording_tags": tags, "unmapped_genres": sorted(unmapped),
+            "tags": dict(most_common(tag_counts))}
+
+
+def overlap_matrix(sets: Dict[str, set]) -> Dict[str, Dict[str, int]]:
+    """The size of the intersection of each pair of sets"""
+    return {a: {b: len(sets[a] & sets[b]) for b in sets} for a in sets}
+
+
+def shared_subgenres(file_genres: Dict[str, Dict[str, Set[str]]]) -> Dict[str, List[Tuple[str, str]]]:
+    """Subgenres that are used under more than one parent genre or source, with each (source name, parent genre)"""
+    sg_map = collections.defaultdict(set)
+    for datafile, genres in file_genres.items():
+        source = source_name(datafile)
+        for g, sgs in genres.items():
+            for sg in sgs:
+                sg_map[sg].add((source, g))
+    return {sg: sorted(sg_map[sg]) for sg in sorted(sg_map.keys()) if len(sg_map[sg]) > 1}
+
+
+def compute_stats(file_counts: Dict[str, collections.Counter],
+                  source_matches: Optional[Dict[str, Dict[str, List[str]]]] = None, cooccurrence=False) -> Dict:
+    """
+    Work out the stats for each data file from its genre list counts, and the overlaps between them.
+    Everything is keyed by the path of the data file, because files in different directories can have the same name
+    :param file_counts: from count_files
+    :param source_matches: the tags for each genre (from load_matches) for some or all of the data files
+    :param cooccurrence: also count the recordings with each pair of parent genres. This is slow for large files,
+                         so it's only done for --json
+    """
+    sources = {}
+    file_genres = {}
+    file_tags = {}
+    for datafile, genre_lists in file_counts.items():
+        genres = genre_counts(genre_lists)
+        parents = subgenres_by_parent(genres)
+        file_genres[datafile] = parents
+        sources[datafile] = {
+            "name": source_name(datafile),
+            "recordings": sum(genre_lists.values()),
+            "genre_lists": len(genre_lists),
+            "parent_genres": len(parents),
+            "genres": dict(most_common(genres)),
+        }
+        if cooccurrence:
+            sources[datafile]["parent_cooccurrence"] = \
+                [[a, b, count] for (a, b), count in most_common(parent_cooccurrence(genre_lists))]
+        if source_matches and datafile in source_matches:
+            volume = tag_volume(genre_lists, source_matches[datafile])
+            sources[datafile]["tag_volume"] = volume
+            file_tags[datafile] = set(volume["tags"])
+
+    return {
+        "sources": sources,
+        "genre_overlap": overlap_matrix({f: set(v["genres"]) for f, v in sources.items()}),
+        "subgenre_overlap": overlap_matrix({f: set().union(*g.values()) for f, g in file_genres.items()}),
+        "tag_overlap": overlap_matrix(file_tags),
+        "shared_subgenres": shared_subgenres(file_genres),
+    }
+
+
+def main(files, debug, num_workers=None, cache_file=None, matches=None, json_file=None):
+    # --matches NAME FILE applies to the data files with NAME in their name
+    source_matches = {}
+    for name, matches_file in matches or []:
+        mapping = load_matches(matches_file)
+        for f in files:
+            if name in os.path.basename(f):
+                source_matches[f] = mapping
+
+    if json_file or cache_file or source_matches:
+        file_counts = count_files(files, num_workers, cache_file)
+        results = compute_stats(file_counts, source_matches, cooccurrence=json_file is not None)
+        file_genres = {datafile: subgenres_by_parent(s["genres"]) for datafile, s in results["sources"].items()}
+    else:
+        # Only the genres of each file are printed, so don't count the genre lists
+        file_genres = {datafile: subgenres_by_parent(counts)
+                       for datafile, counts in count_files(files, num_workers, genre_lists=False).items()}
+        results = {"sources": {}, "shared_subgenres": shared_subgenres(file_genres)}
+
     for fname in files:
         print(fname)
-        genres = load_genres(fname)
         if debug:
+            genres = file_genres[fname]
             for g in sorted(genres.keys()):
                 print(g)
                 for sg in sorted(genres[g]):
                     print(f"  - {sg}")
-        filegenres[fname] = genres
 
     # Check if there are any subgenres that are shared between different genres/sources
-    sg_map = collections.defaultdict(set)
-    for f, genres in filegenres.items():
-        source, ext = os.path.splitext(os.path.basename(f))
-        for g, sgs in genres.items():
-            for sg in sgs:
-                sg_map[sg].add((source, g))
-    for sg in sorted(sg_map.keys()):
-        sources = sg_map[sg]
-        if len(sources) > 1:
-            print(sg, "-", ", ".join([f"{source}:{genre}" for source, genre in sources]))
+    for sg, sources in results["shared_subgenres"].items():
+        print(sg, "-", ", ".join([f"{source}:{genre}" for source, genre in sources]))
+
+    for datafile, source_stats in results["sources"].items():
+        volume = source_stats.get("tag_volume")
+        if volume:
+            print(f"{datafile}: {volume['recording_tags']} tags for {volume['recordings_with_tags']} of "
+                  f"{source_stats['recordings']} recordings, {len(volume['tags'])} different tags, "
+                  f"{len(volume['unmapped_genres'])} genres not in the matches")
+
+    if json_file:
+        with open(json_file, "w") as fp:
+            json.dump(results, fp, indent=2)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('-j', '--workers', type=int, required=False,
+                        help='Number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--cache', required=False,
+                        help='Keep the counts for each file in this database, and only read files that changed')
+    parser.add_argument('--matches', nargs=2, action='append', metavar=('NAME', 'MATCHES'),
+                        help='Count the tags that the matches from main.py give the data files with NAME in their '
+                             'file name. Can be given more than once')
+    parser.add_argument('--json', required=False, help='Write all stats to this json file')
     parser.add_argument('files', nargs='+')
 
     args = parser.parse_args()
-    main(args.files, args.debug)
+    main(args.files, args.debug, args.workers, args.cache, args.matches, args.json)
@@ -0,0 +1,328 @@
+# A precomputed, memory-mapped version of a MusicBrainz tag list (mb_tags.csv)
+# The processed forms of each tag name are computed once and stored in a binary file next to the csv,
+# so that later runs can load them without normalizing every tag again.
+# The index file records a hash of the csv that it was built from, and is rebuilt if the csv changes.
+# The lookup tables that matching uses (tags by processed name, by lowercase name and by sorted tokens) are also
+# stored, so that keys can be looked up in the file instead of loading every name into a dict first. For each key
+# there are the positions of the tags in order of the key, and a hash table (open addressing with linear probing,
+# hashed with crc32 so that it's the same in every process) from each distinct key to its first sorted position.
+#
+#   python tag_index.py mapping/mb_tags.csv
+
+import argparse
+import array
+import csv
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import zlib
+from typing import Iterator, List, Mapping, Optional, Sequence, Tuple
+
+import normalize
+
+MAGIC = b"MBTAGIDX"
+INDEX_VERSION = 3
+
+# magic, version, sha256 of the csv, number of tags
+HEADER = struct.Struct("<8sI32sQ")
+# offset and length of a section in the file
+SECTION = struct.Struct("<QQ")
+
+STRING_COLUMNS = ["name", "processed_name_words", "processed_name", "sorted_tokens", "lowercase_name"]
+# The columns that tags are looked up by. For each of these, the index has the positions of the tags sorted by it
+KEY_COLUMNS = ["processed_name", "lowercase_name", "sorted_tokens"]
+# Tag names can't contain a NUL, so it can be used to separate them in a column
+SEPARATOR = "\0"
+# is_genre, ref_count, then offsets and data for each string column, then the sorted positions and hash table
+# of each key column
+NUM_SECTIONS = 2 + 2 * len(STRING_COLUMNS) + 2 * len(KEY_COLUMNS)
+
+
+def default_index_path(genrefile: str) -> str:
+    return f"{genrefile}.idx"
+
+
+def csv_hash(genrefile: str) -> bytes:
+    h = hashlib.sha256()
+    with open(genrefile, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
+
+
+def _pad(fp):
+    """Align the next section to 8 bytes so that it can be cast to an array of integers"""
+    fp.write(b"\0" * (-fp.tell() % 8))
+
+
+def _hash_table(sorted_keys: List[bytes]) -> array.array:
+    """
+    A hash table of the distinct keys in a sorted list. Each slot has 1 + the position in the list of the first
+    of a key, or 0 if it's empty. There are at least twice as many slots as keys, so that probes are short
+    """
+    size = 1
+    while size < 2 * len(sorted_keys):
+        size *= 2
+    slots = array.array("I", bytes(4 * size))
+    for i, key in enumerate(sorted_keys):
+        if i > 0 and key == sorted_keys[i - 1]:
+            continue
+        slot = zlib.crc32(key) & (size - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (size - 1)
+        slots[slot] = i + 1
+    return slots
+
+
+def build_tag_index(genrefile: str, indexfile: Optional[str] = None):
+    """Read a musicbrainz tag csv, process all names, and write an index file"""
+    if indexfile is None:
+        indexfile = default_index_path(genrefile)
+    digest = csv_hash(genrefile)
+
+    columns = {c: [] for c in STRING_COLUMNS}
+    is_genre = bytearray()
+    ref_count = array.array("q")
+    with open(genrefile) as fp:
+        reader = csv.DictReader(fp)
+        for line in reader:
+            columns["name"].append(line["name"])
+            is_genre.append(line["has_genre"] == 't')
+            ref_count.append(int(line["ref_count"]))
+    normalized = normalize.normalize_all(columns["name"])
+    columns["processed_name_words"] = [n.words for n in normalized]
+    columns["processed_name"] = [n.key for n in normalized]
+    columns["sorted_tokens"] = normalize.sorted_tokens_all(columns["processed_name_words"])
+    columns["lowercase_name"] = [name.lower() for name in columns["name"]]
+
+    sections = []
+    tmpfile = f"{indexfile}.tmp"
+    with open(tmpfile, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, INDEX_VERSION, digest, len(is_genre)))
+        table_start = fp.tell()
+        fp.write(b"\0" * SECTION.size * NUM_SECTIONS)
+
+        def write_section(data):
+            _pad(fp)
+            sections.append((fp.tell(), len(data)))
+            fp.write(data)
+
+        write_section(bytes(is_genre))
+        write_section(ref_count.tobytes())
+        encoded = {}
+        for c in STRING_COLUMNS:
+            encoded[c] = [s.encode("utf-8") for s in columns[c]]
+            offsets = array.array("I", [0])
+            for e in encoded[c]:
+                offsets.append(offsets[-1] + len(e) + 1)
+            write_section(offsets.tobytes())
+            write_section(SEPARATOR.encode("utf-8").join(encoded[c]))
+        for c in KEY_COLUMNS:
+            # Sorted by the encoded key, which is the order that KeyTable compares them in. The sort is stable,
+            # so the tags with the same key stay in the order of the csv
+            order = sorted(range(len(is_genre)), key=encoded[c].__getitem__)
+            write_section(array.array("I", order).tobytes())
+            write_section(_hash_table([encoded[c][position] for position in order]).tobytes())
+
+        fp.seek(table_start)
+        for section in sections:
+            fp.write(SECTION.pack(*section))
+    os.replace(tmpfile, indexfile)
+
+
+class TagIndex:
+    """
+    A memory-mapped tag index file. Columns are read from the file when they are requested,
+    either all at once (`column`), for a single tag (`get`), or as a sequence that reads each tag when it's used
+    (`lazy_column`). Tags can be looked up by the columns in KEY_COLUMNS with `key_table`.
+    A TagIndex can be pickled, and is opened again from the same file when it's unpickled
+    """
+
+    def __init__(self, indexfile: str):
+        self.path = indexfile
+        with open(indexfile, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.csv_hash, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{indexfile} is not a tag index")
+        if self.version != INDEX_VERSION:
+            # The sections of another version can be different, so don't try to read them
+            return
+        sections = [SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size) for i in range(NUM_SECTIONS)]
+        view = memoryview(self._mmap)
+
+        def section(i):
+            offset, length = sections[i]
+            return view[offset:offset + length]
+
+        self.is_genre = section(0)
+        self.ref_count = section(1).cast("q")
+        self._offsets = {}
+        self._data = {}
+        for i, c in enumerate(STRING_COLUMNS):
+            self._offsets[c] = section(2 + 2 * i).cast("I")
+            self._data[c] = section(3 + 2 * i)
+        self._sorted_positions = {}
+        self._hash_tables = {}
+        for i, c in enumerate(KEY_COLUMNS):
+            self._sorted_positions[c] = section(2 + 2 * len(STRING_COLUMNS) + 2 * i).cast("I")
+            self._hash_tables[c] = section(3 + 2 * len(STRING_COLUMNS) + 2 * i).cast("I")
+
+    def __len__(self):
+        return self.count
+
+    def __reduce__(self):
+        return TagIndex, (self.path, )
+
+    def column(self, name: str) -> List[str]:
+        if self.count == 0:
+            return []
+        return str(self._data[name], "utf-8").split(SEPARATOR)
+
+    def get(self, name: str, position: int) -> str:
+        return str(self.get_bytes(name, position), "utf-8")
+
+    def get_bytes(self, name: str, position: int) -> bytes:
+        offsets = self._offsets[name]
+        return bytes(self._data[name][offsets[position]:offsets[position + 1] - 1])
+
+    def column_sections(self, name: str) -> Tuple[memoryview, memoryview]:
+        """The offsets and data of a string column, which `get` reads a tag's value from"""
+        return self._offsets[name], self._data[name]
+
+    def sorted_positions(self, name: str) -> memoryview:
+        """The positions of the tags, in order of a column in KEY_COLUMNS"""
+        return self._sorted_positions[name]
+
+    def hash_table(self, name: str) -> memoryview:
+        """The hash table of a column in KEY_COLUMNS, from each distinct value to its first sorted position"""
+        return self._hash_tables[name]
+
+    def lazy_column(self, name: str) -> "LazyColumn":
+        return LazyColumn(self, name)
+
+    def key_table(self, name: str) -> "KeyTable":
+        return KeyTable(self, name)
+
+
+class LazyColumn(Sequence[str]):
+    """A column of a tag index, which only reads a tag's value when it's used"""
+
+    def __init__(self, index: TagIndex, name: str):
+        self.index = index
+        self.name = name
+        self._count = len(index)
+        self._offsets, self._data = index.column_sections(name)
+
+    def __reduce__(self):
+        return LazyColumn, (self.index, self.name)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self) -> Iterator[str]:
+        # Reading the whole column at once is quicker than reading each tag
+        return iter(self.index.column(self.name))
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[p] for p in range(*position.indices(len(self)))]
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError(position)
+        return str(self._data[self._offsets[position]:self._offsets[position + 1] - 1], "utf-8")
+
+
+class KeyTable(Mapping[str, Tuple[int, ...]]):
+    """
+    Map each value of a key column to the positions of the tags with that value, by looking the value up in the
+    hash table of the column, and then reading the positions sorted by the column from there while they have the same
+    value. Iterating over the table gives each distinct value once, in sorted order
+    """
+
+    def __init__(self, index: TagIndex, name: str):
+        self.index = index
+        self.name = name
+        self._count = len(index)
+        self._offsets, self._data = index.column_sections(name)
+        self._positions = index.sorted_positions(name)
+        self._slots = index.hash_table(name)
+        self._len = None
+
+    def __reduce__(self):
+        return KeyTable, (self.index, self.name)
+
+    def _key(self, i: int) -> memoryview:
+        """The value of the i-th tag in sorted order. A memoryview compares equal to bytes with the same contents"""
+        position = self._positions[i]
+        return self._data[self._offsets[position]:self._offsets[position + 1] - 1]
+
+    def get(self, key: str, default=None):
+        # Overridden because Mapping.get catches the KeyError from __getitem__, which is slow for keys
+        # that aren't found, and most lookups are for keys that aren't in the table
+        encoded = key.encode("utf-8")
+        mask = len(self._slots) - 1
+        slot = zlib.crc32(encoded) & mask
+        while True:
+            i = self._slots[slot]
+            if not i:
+                return default
+            if self._key(i - 1) == encoded:
+                break
+            slot = (slot + 1) & mask
+        positions = [self._positions[i - 1]]
+        while i < self._count and self._key(i) == encoded:
+            positions.append(self._positions[i])
+            i += 1
+        return tuple(positions)
+
+    def __getitem__(self, key: str) -> Tuple[int, ...]:
+        positions = self.get(key)
+        if positions is None:
+            raise KeyError(key)
+        return positions
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        previous = None
+        for i in range(self._count):
+            key = bytes(self._key(i))
+            if key != previous:
+                yield str(key, "utf-8")
+                previous = key
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum(1 for _ in self)
+        return self._len
+
+
+def load_tag_index(genrefile: str, indexfile: Optional[str] = None) -> TagIndex:
+    """Load the index for a musicbrainz tag csv, building it first if it doesn't exist or is out of date"""
+    if indexfile is None:
+        indexfile = default_index_path(genrefile)
+    digest = csv_hash(genrefile)
+    if os.path.exists(indexfile):
+        try:
+            index = TagIndex(indexfile)
+        except (ValueError, struct.error):
+            # Not an index, or written by a different version. Build it again
+            index = None
+        if index is not None and index.version == INDEX_VERSION and index.csv_hash == digest:
+            return index
+    build_tag_index(genrefile, indexfile)
+    return TagIndex(indexfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', required=False, help='Index file to write (default <genrefile>.idx)')
+    parser.add_argument('genrefile')
+    args = parser.parse_args()
+    build_tag_index(args.genrefile, args.o)
+    print(f"wrote {args.o or default_index_path(args.genrefile)}", file=sys.stderr)
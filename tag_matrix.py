@@ -0,0 +1,267 @@
+# A compact binary version of a tag file made by generate_mb_tags_for_source.py: the tags of each recording, stored
+# as a sparse recording x tag matrix that can be memory-mapped and read without parsing the whole file.
+#
+#   python generate_mb_tags_for_source.py --matrix lastfm-tags.tagmatrix lastfm-to-mb-tags.csv data/lastfm.tsv
+#   python tag_matrix.py info lastfm-tags.tagmatrix
+#   python tag_matrix.py csv lastfm-tags.tagmatrix > lastfm-tags-to-submit.csv
+#   python tag_matrix.py diff old.tagmatrix new.tagmatrix
+#
+# The file has a list of tag names, then one row for each recording, sorted by mbid. mbids are stored as 16 bytes,
+# and the tags of row i are the tag numbers indices[indptr[i]:indptr[i + 1]] (the CSR sparse matrix format).
+# Each recording is only in the file once, with its tags in the same order as in a csv tag file.
+
+import argparse
+import array
+import collections
+import csv
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+MAGIC = b"MBTAGMTX"
+MATRIX_VERSION = 1
+
+# magic, version, number of recordings, number of tags, number of (recording, tag) pairs,
+# typecode of indptr, typecode of indices
+HEADER = struct.Struct("<8sIQQQcc")
+# offset and length of a section in the file
+SECTION = struct.Struct("<QQ")
+# tag name offsets, tag names, mbids, indptr, indices
+NUM_SECTIONS = 5
+MBID_SIZE = 16
+# Tag names can't contain a NUL, so it can be used to separate them
+SEPARATOR = "\0"
+
+
+def _typecode(max_value: int) -> str:
+    """The smallest unsigned array typecode that can hold max_value"""
+    for typecode in "HIQ":
+        if max_value < 1 << (8 * array.array(typecode).itemsize):
+            return typecode
+    raise ValueError(f"{max_value} is too large")
+
+
+def _pad(fp):
+    """Align the next section to 8 bytes so that it can be cast to an array of integers"""
+    fp.write(b"\0" * (-fp.tell() % 8))
+
+
+def mbid_bytes(mbid: str) -> bytes:
+    """An mbid as 16 bytes. Raises ValueError if it isn't a valid mbid"""
+    # Quicker than uuid.UUID, which makes a difference for a million recordings
+    b = bytes.fromhex(mbid.replace("-", ""))
+    if len(b) != MBID_SIZE or len(mbid) != 36:
+        raise ValueError(f"{mbid} is not a valid mbid")
+    return b
+
+
+def mbid_str(b: bytes) -> str:
+    h = b.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def is_tag_matrix(path: str) -> bool:
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def write_tag_matrix(path: str, tags: List[str], mbids: bytes, indptr: List[int], indices: List[int]):
+    """
+    Write a tag matrix file
+    :param tags: the tag names
+    :param mbids: the mbid of each recording, as 16 bytes each, in sorted order
+    :param indptr: for each recording, the position in indices of its first tag, and then the length of indices
+    :param indices: the tag numbers of each recording
+    """
+    num_rows = len(mbids) // MBID_SIZE
+    if len(indptr) != num_rows + 1:
+        raise ValueError("indptr must have one more item than the number of recordings")
+    indptr_typecode = _typecode(len(indices))
+    indices_typecode = _typecode(len(tags))
+
+    sections = []
+    tmpfile = f"{path}.tmp"
+    with open(tmpfile, "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, MATRIX_VERSION, num_rows, len(tags), len(indices),
+                             indptr_typecode.encode(), indices_typecode.encode()))
+        table_start = fp.tell()
+        fp.write(b"\0" * SECTION.size * NUM_SECTIONS)
+
+        def write_section(data):
+            _pad(fp)
+            sections.append((fp.tell(), len(data)))
+            fp.write(data)
+
+        encoded = [t.encode("utf-8") for t in tags]
+        offsets = array.array("I", [0])
+        for e in encoded:
+            offsets.append(offsets[-1] + len(e) + 1)
+        write_section(offsets.tobytes())
+        write_section(SEPARATOR.encode("utf-8").join(encoded))
+        write_section(bytes(mbids))
+        write_section(array.array(indptr_typecode, indptr).tobytes())
+        write_section(array.array(indices_typecode, indices).tobytes())
+
+        fp.seek(table_start)
+        for section in sections:
+            fp.write(SECTION.pack(*section))
+    os.replace(tmpfile, path)
+
+
+class TagMatrix:
+    """
+    A memory-mapped tag matrix file. Rows are read from the file when they are requested, so reading part of a
+    large file is quick, and the mbids, indptr and indices arrays are views of the file, not copies
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.num_rows, num_tags, self.nnz, indptr_typecode, indices_typecode = \
+            HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a tag matrix")
+        if self.version != MATRIX_VERSION:
+            raise ValueError(f"{path} is a version {self.version} tag matrix, expected {MATRIX_VERSION}")
+        sections = [SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size) for i in range(NUM_SECTIONS)]
+        view = memoryview(self._mmap)
+
+        def section(i):
+            offset, length = sections[i]
+            return view[offset:offset + length]
+
+        self.tags = str(section(1), "utf-8").split(SEPARATOR) if num_tags else []
+        self.mbids = section(2)
+        self.indptr = section(3).cast(indptr_typecode.decode())
+        self.indices = section(4).cast(indices_typecode.decode())
+
+    def __len__(self):
+        return self.num_rows
+
+    def mbid(self, row: int) -> str:
+        return mbid_str(self.mbids[row * MBID_SIZE:(row + 1) * MBID_SIZE])
+
+    def tag_ids(self, row: int) -> memoryview:
+        return self.indices[self.indptr[row]:self.indptr[row + 1]]
+
+    def row_tags(self, row: int) -> List[str]:
+        return [self.tags[t] for t in self.tag_ids(row)]
+
+    def rows(self, start=0, stop=None) -> Iterator[List[str]]:
+        """Rows from start to stop, in the same format as the rows of a csv tag file: [mbid, tag, tag, ...]"""
+        if stop is None:
+            stop = self.num_rows
+        for row in range(start, stop):
+            yield [self.mbid(row)] + self.row_tags(row)
+
+    def find(self, mbid: str) -> Optional[int]:
+        """The row of a recording, or None if it isn't in the file"""
+        key = mbid_bytes(mbid)
+        lo, hi = 0, self.num_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.mbids[mid * MBID_SIZE:(mid + 1) * MBID_SIZE]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_rows and self.mbids[lo * MBID_SIZE:(lo + 1) * MBID_SIZE] == key:
+            return lo
+        return None
+
+    def tag_counts(self) -> Dict[str, int]:
+        """The number of recordings with each tag"""
+        counts = collections.Counter(self.indices)
+        return {self.tags[t]: count for t, count in counts.most_common()}
+
+    def close(self):
+        self.indptr.release()
+        self.indices.release()
+        self.mbids.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def diff(old: TagMatrix, new: TagMatrix) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """
+    The recordings whose tags are different in new, as (mbid, old tags, new tags). Recordings that are only in
+    one of the files have no tags in the other. Both files are sorted by mbid, so they are read side by side
+    """
+    # Tag numbers are different in each file, so compare the tag numbers of new with the tag numbers in old
+    # that have the same name. Tags that aren't in new can't be equal to any of them
+    new_tag_ids = {tag: i for i, tag in enumerate(new.tags)}
+    old_to_new = [new_tag_ids.get(tag, -1) for tag in old.tags]
+    i = j = 0
+    while i < len(old) or j < len(new):
+        old_mbid = bytes(old.mbids[i * MBID_SIZE:(i + 1) * MBID_SIZE]) if i < len(old) else None
+        new_mbid = bytes(new.mbids[j * MBID_SIZE:(j + 1) * MBID_SIZE]) if j < len(new) else None
+        if new_mbid is None or (old_mbid is not None and old_mbid < new_mbid):
+            yield mbid_str(old_mbid), old.row_tags(i), []
+            i += 1
+        elif old_mbid is None or new_mbid < old_mbid:
+            yield mbid_str(new_mbid), [], new.row_tags(j)
+            j += 1
+        else:
+            if [old_to_new[t] for t in old.tag_ids(i)] != list(new.tag_ids(j)):
+                yield mbid_str(new_mbid), old.row_tags(i), new.row_tags(j)
+            i += 1
+            j += 1
+
+
+def main_info(path):
+    with TagMatrix(path) as matrix:
+        print(f"{len(matrix)} recordings, {len(matrix.tags)} tags, {matrix.nnz} recording tags, "
+              f"{os.path.getsize(path)} bytes")
+        for tag, count in matrix.tag_counts().items():
+            print(f"{count}\t{tag}")
+
+
+def main_csv(path):
+    writer = csv.writer(sys.stdout)
+    with TagMatrix(path) as matrix:
+        writer.writerows(matrix.rows())
+
+
+def main_diff(old_path, new_path):
+    added = removed = changed = 0
+    tags_added = collections.Counter()
+    tags_removed = collections.Counter()
+    with TagMatrix(old_path) as old, TagMatrix(new_path) as new:
+        for mbid, old_tags, new_tags in diff(old, new):
+            if not old_tags:
+                added += 1
+            elif not new_tags:
+                removed += 1
+            else:
+                changed += 1
+            tags_added.update(set(new_tags) - set(old_tags))
+            tags_removed.update(set(old_tags) - set(new_tags))
+    print(f"{added} recordings added, {removed} removed, {changed} with different tags")
+    for tag in sorted(tags_added.keys() | tags_removed.keys()):
+        print(f"+{tags_added[tag]}\t-{tags_removed[tag]}\t{tag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    info_parser = subparsers.add_parser("info", help="Print the number of recordings with each tag")
+    info_parser.add_argument("matrix")
+    csv_parser = subparsers.add_parser("csv", help="Write the tags as a csv tag file to stdout")
+    csv_parser.add_argument("matrix")
+    diff_parser = subparsers.add_parser("diff", help="Print how many recordings and tags changed between two files")
+    diff_parser.add_argument("old")
+    diff_parser.add_argument("new")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        main_info(args.matrix)
+    elif args.command == "csv":
+        main_csv(args.matrix)
+    elif args.command == "diff":
+        main_diff(args.old, args.new)
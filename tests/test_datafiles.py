@@ -0,0 +1,35 @@
+import bz2
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import datafiles  # noqa: E402
+
+
+def test_empty_bz2_file_in_parallel(tmp_path):
+    datafile = tmp_path / "empty.tsv.bz2"
+    datafile.write_bytes(bz2.compress(b""))
+    assert list(datafiles.iter_bz2_parallel(str(datafile), 4)) == []
+    with datafiles.open_binary(str(datafile), num_threads=4) as fp:
+        assert fp.read() == b""
+
+
+def test_bz2_file_in_parallel(tmp_path):
+    data = "".join(f"recording{i}\trelease{i}\trock---indie rock\n" for i in range(100000)).encode("utf-8")
+    datafile = tmp_path / "data.tsv.bz2"
+    datafile.write_bytes(bz2.compress(data, compresslevel=1))
+    assert b"".join(datafiles.iter_bz2_parallel(str(datafile), 4)) == data
+
+
+def test_chunks_of_compressed_files(tmp_path):
+    rows = [[f"recording{i}", f"release{i}", "rock---indie rock", "pop"] for i in range(20000)]
+    data = "recordingmbid\treleasegroupmbid\tgenre1\tgenre2\n" + "".join("\t".join(row) + "\n" for row in rows)
+    plain = tmp_path / "data.tsv"
+    plain.write_text(data)
+    compressed = tmp_path / "data.tsv.bz2"
+    compressed.write_bytes(bz2.compress(data.encode("utf-8")))
+    for datafile in [plain, compressed]:
+        chunks = list(datafiles.iter_chunks(str(datafile), chunk_bytes=100000))
+        assert len(chunks) > 1
+        assert [row for chunk in chunks for row in datafiles.read_rows(chunk)] == rows
@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import generate_mb_tags_for_source  # noqa: E402
+
+
+def test_load_mapping_skips_near_misses(tmp_path):
+    matches = tmp_path / "matches.csv"
+    matches.write_text("source parent genre,source subgenre,mb tag,type,genre?,mb tag,type,genre?\n"
+                       "electronic,drumnbasss,electronic,parent,,drum n bass,fuzzy subgenre 95,n\n"
+                       "lectronic,,electronic,fuzzy parent 95,\n"
+                       "rock,blues rock,rock,parent,,blues rock,subgenre,\n")
+    assert generate_mb_tags_for_source.load_mapping(str(matches)) == {
+        "electronic---drumnbasss": ["electronic"],
+        "lectronic": [],
+        "rock---blues rock": ["rock", "blues rock"],
+    }
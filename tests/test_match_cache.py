@@ -0,0 +1,106 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+
+WORDS = ["rock", "pop", "indie", "drum", "bass", "and", "n", "synth", "jazz", "hop", "hip", "metal", "death", "dub",
+         "techno"]
+
+
+def random_name(rng: random.Random) -> str:
+    words = rng.sample(WORDS, rng.randint(1, 3))
+    name = rng.choice([" ", "-", "", " & "]).join(words)
+    return name.title() if rng.random() < 0.2 else name
+
+
+def make_tags(rng: random.Random, n: int) -> dict:
+    tags = {}
+    while len(tags) < n:
+        tags[random_name(rng)] = (rng.random() < 0.3, rng.randint(1, 1000))
+    return tags
+
+
+def write_tags(path, tags: dict) -> str:
+    with open(path, "w") as fp:
+        fp.write("name,has_genre,ref_count\n")
+        for name, (is_genre, count) in tags.items():
+            fp.write(f"{name},{'t' if is_genre else 'f'},{count}\n")
+    return str(path)
+
+
+def match(genrefile, genres, cache_file=None, **kwargs):
+    metrics = main.Metrics()
+    matches = main.match_genres(genres, main.load_musicbrainz_genres(genrefile), num_workers=1,
+                                match_cache_file=cache_file, genrefile=genrefile if cache_file else None,
+                                metrics=metrics, **kwargs)
+    return {genre.full_genre: results for genre, results in matches.items()}, metrics.counts.get("match_cache")
+
+
+def assert_cache_matches(genrefile, genres, cache_file, **kwargs):
+    cached, counts = match(genrefile, genres, cache_file, **kwargs)
+    uncached, _ = match(genrefile, genres, **kwargs)
+    assert cached == uncached
+    return counts
+
+
+def test_cached_results_follow_tag_changes(tmp_path):
+    rng = random.Random(1)
+    tags = make_tags(rng, 300)
+    genres = list({f"{random_name(rng)}---{random_name(rng)}" for _ in range(150)} |
+                  {random_name(rng) for _ in range(50)})
+    genrefile = tmp_path / "mb_tags.csv"
+    cache_file = str(tmp_path / "cache.db")
+
+    counts = assert_cache_matches(write_tags(genrefile, tags), genres, cache_file)
+    assert counts["cached"] == 0
+    counts = assert_cache_matches(str(genrefile), genres, cache_file)
+    assert counts["matched"] == 0
+
+    # Add, remove, and change the genre flag and ref_count of some tags
+    names = list(tags)
+    for name in rng.sample(names, 30):
+        del tags[name]
+    for name in rng.sample(list(tags), 30):
+        is_genre, count = tags[name]
+        tags[name] = (not is_genre, count)
+    for name in rng.sample(list(tags), 10):
+        is_genre, count = tags[name]
+        tags[name] = (is_genre, count + 1)
+    tags.update(make_tags(rng, 20))
+    counts = assert_cache_matches(write_tags(genrefile, tags), genres, cache_file)
+    assert counts["stale"] > 0
+    assert counts["cached"] > 0
+
+
+def test_cached_near_misses_follow_tag_changes(tmp_path):
+    rng = random.Random(2)
+    tags = make_tags(rng, 200)
+    genres = list({f"{random_name(rng)}---{random_name(rng)}" for _ in range(60)})
+    genrefile = tmp_path / "mb_tags.csv"
+    cache_file = str(tmp_path / "cache.db")
+
+    assert_cache_matches(write_tags(genrefile, tags), genres, cache_file, min_ratio=85)
+    # Tags that are one letter different from a genre are near misses of it, but don't match it exactly
+    for genre in rng.sample(genres, 10):
+        tags[genre.split("---")[1] + "s"] = (True, 1)
+    counts = assert_cache_matches(write_tags(genrefile, tags), genres, cache_file, min_ratio=85)
+    assert counts["stale"] > 0
+
+
+def test_cache_is_cleared_when_the_settings_change(tmp_path):
+    rng = random.Random(3)
+    tags = make_tags(rng, 200)
+    genres = list({f"{random_name(rng)}---{random_name(rng)}" for _ in range(60)})
+    genrefile = write_tags(tmp_path / "mb_tags.csv", tags)
+    cache_file = str(tmp_path / "cache.db")
+
+    assert_cache_matches(genrefile, genres, cache_file, min_ratio=85, top_k=3)
+    counts = assert_cache_matches(genrefile, genres, cache_file, min_ratio=85, top_k=1)
+    assert counts["cached"] == 0
+    counts = assert_cache_matches(genrefile, genres, cache_file)
+    assert counts["cached"] == 0
+    counts = assert_cache_matches(genrefile, genres, cache_file)
+    assert counts["matched"] == 0
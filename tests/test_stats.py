@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import stats  # noqa: E402
+
+
+def write_datafile(path, rows):
+    path.parent.mkdir(exist_ok=True)
+    path.write_text("recordingmbid\treleasegroupmbid\tgenre1\tgenre2\n"
+                    + "".join("\t".join(row) + "\n" for row in rows))
+    return str(path)
+
+
+def test_files_with_the_same_name_are_kept_apart(tmp_path):
+    train = write_datafile(tmp_path / "train" / "lastfm.tsv", [["r1", "g1", "rock---indie rock", "pop"]])
+    validation = write_datafile(tmp_path / "validation" / "lastfm.tsv", [["r2", "g2", "jazz---bebop", ""]])
+    results = stats.compute_stats(stats.count_files([train, validation], num_workers=1), cooccurrence=True)
+
+    assert list(results["sources"]) == [train, validation]
+    assert results["sources"][train]["name"] == "lastfm"
+    assert results["sources"][train]["genres"] == {"pop": 1, "rock---indie rock": 1}
+    assert results["sources"][train]["parent_cooccurrence"] == [["pop", "rock", 1]]
+    assert results["sources"][validation]["genres"] == {"jazz---bebop": 1}
+    assert results["genre_overlap"][train][validation] == 0
+
+
+def test_genre_counts_without_genre_lists(tmp_path):
+    datafile = write_datafile(tmp_path / "lastfm.tsv", [["r1", "g1", "rock---indie rock", "pop"],
+                                                        ["r2", "g2", "rock", ""], ["r3", "g3", "pop", "rock"]])
+    genre_lists = stats.count_files([datafile], num_workers=1)[datafile]
+    genres = stats.count_files([datafile], num_workers=1, genre_lists=False)[datafile]
+    assert genres == stats.genre_counts(genre_lists) == {"rock": 2, "pop": 2, "rock---indie rock": 1}
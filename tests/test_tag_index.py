@@ -0,0 +1,51 @@
+import os
+import pickle
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+import tag_index  # noqa: E402
+
+
+def write_tags(path, tags):
+    path.write_text("name,has_genre,ref_count\n" + "".join(f"{name},{is_genre},{count}\n"
+                                                           for name, is_genre, count in tags))
+    return str(path)
+
+
+TAGS = [("Drum and Bass", "t", 10), ("drum & bass", "f", 3), ("rock", "t", 50), ("Rock", "f", 2),
+        ("bass drum and", "f", 1), ("électronique", "f", 4)]
+
+
+def test_key_tables_match_the_tag_list(tmp_path):
+    genrefile = write_tags(tmp_path / "mb_tags.csv", TAGS)
+    index = tag_index.load_tag_index(genrefile)
+    loaded = main.MusicBrainzGenreIndex.from_tag_index(index)
+    built = main.MusicBrainzGenreIndex(index.column("name"), index.column("processed_name"), index.is_genre,
+                                       index.ref_count, index.column("sorted_tokens"))
+    for table in ["by_processed_name", "by_lowercase_name", "by_sorted_tokens"]:
+        assert list(getattr(loaded, table)) == sorted(getattr(built, table))
+        for key in list(getattr(built, table)) + ["", "jazz", "zzz"]:
+            assert main._lookup_positions(getattr(loaded, table), key) == \
+                main._lookup_positions(getattr(built, table), key)
+    assert list(loaded.names) == [name for name, _, _ in TAGS]
+
+
+def test_index_can_be_pickled(tmp_path):
+    genrefile = write_tags(tmp_path / "mb_tags.csv", TAGS)
+    mb_index = pickle.loads(pickle.dumps(main.load_musicbrainz_genres(genrefile)))
+    genre = main.parse_service_genre("rock---drum and bass", 1)
+    assert [(m.musicbrainz.name, m.match_type) for m in mb_index.match(genre)] == \
+        [("Drum and Bass", main.MatchType.SUBGENRE), ("Drum and Bass", main.MatchType.EXACT),
+         ("rock", main.MatchType.PARENTGENRE), ("Rock", main.MatchType.PARENTGENRE)]
+
+
+def test_fuzzy_tables_are_pickled_with_the_index(tmp_path):
+    genrefile = write_tags(tmp_path / "mb_tags.csv", TAGS)
+    mb_index = main.load_musicbrainz_genres(genrefile)
+    assert not hasattr(pickle.loads(pickle.dumps(mb_index)), "ngrams_by_length")
+    mb_index.build_fuzzy_index()
+    unpickled = pickle.loads(pickle.dumps(mb_index))
+    assert unpickled.names_by_length == mb_index.names_by_length
+    assert unpickled.ngrams_by_length == mb_index.ngrams_by_length
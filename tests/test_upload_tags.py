@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import musicbrainzngs  # noqa: E402
+
+import mock_musicbrainz  # noqa: E402
+import upload_tags  # noqa: E402
+
+
+def test_sort_tag_file_without_final_newline(tmp_path):
+    tagfile = tmp_path / "tags.csv"
+    tagfile.write_text("bbbb,x\ncccc,z\naaaa,y")
+    rows = list(upload_tags.sort_tag_file(str(tagfile)))
+    assert rows == [["aaaa", "y"], ["bbbb", "x"], ["cccc", "z"]]
+
+
+def test_sort_tag_file_without_final_newline_in_several_runs(tmp_path):
+    tagfile = tmp_path / "tags.csv"
+    tagfile.write_text("dddd,w\nbbbb,x\ncccc,z\nffff,v\naaaa,y")
+    rows = list(upload_tags.sort_tag_file(str(tagfile), run_rows=3))
+    assert rows == [["aaaa", "y"], ["bbbb", "x"], ["cccc", "z"], ["dddd", "w"], ["ffff", "v"]]
+
+
+class RecordingChunkSizer(upload_tags.ChunkSizer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        super().failure()
+
+
+def test_rejected_chunks_are_split_without_shrinking_chunks(tmp_path, monkeypatch):
+    mbids = [f"{i:08d}-0000-0000-0000-000000000000" for i in range(8)]
+    tagfile = tmp_path / "tags.csv"
+    tagfile.write_text("".join(f"{mbid},rock\n" for mbid in mbids))
+    submitted = []
+
+    def submit_chunk(to_submit, limiter, delay=0.0):
+        if mbids[5] in to_submit:
+            raise musicbrainzngs.ResponseError(cause=SimpleNamespace(reason="Bad Request", headers={}))
+        submitted.extend(to_submit)
+        return 0.0
+
+    monkeypatch.setattr(upload_tags, "submit_chunk", submit_chunk)
+    chunk_sizer = RecordingChunkSizer(initial=8, minimum=1, maximum=8)
+    upload_tags.main("lastfm", str(tagfile), num_workers=1, chunk_sizer=chunk_sizer)
+    assert sorted(submitted) == mbids[:5] + mbids[6:]
+    assert chunk_sizer.failures == 0
+
+
+def test_chunks_are_not_split_when_the_server_cant_be_reached(tmp_path, monkeypatch):
+    mbids = [f"{i:08d}-0000-0000-0000-000000000000" for i in range(8)]
+    tagfile = tmp_path / "tags.csv"
+    tagfile.write_text("".join(f"{mbid},rock\n" for mbid in mbids))
+    attempts = []
+
+    def submit_chunk(to_submit, limiter, delay=0.0):
+        attempts.append(len(to_submit))
+        raise musicbrainzngs.NetworkError(cause=ConnectionRefusedError())
+
+    monkeypatch.setattr(upload_tags, "submit_chunk", submit_chunk)
+    monkeypatch.setattr(upload_tags, "RETRY_DELAY", 0.0)
+    upload_tags.main("lastfm", str(tagfile), num_workers=1,
+                     chunk_sizer=upload_tags.ChunkSizer(initial=8, minimum=1, maximum=8))
+    assert attempts == [8] * upload_tags.MAX_ATTEMPTS
+    with upload_tags.SubmitCache(str(tagfile)) as submit_cache:
+        assert len(submit_cache) == 0
+
+
+def test_token_bucket_rate():
+    bucket = upload_tags.TokenBucket(5, 0.2)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # The first requests are a burst, and then there's one every interval / requests seconds
+    assert time.monotonic() - start < 0.05
+    for _ in range(10):
+        bucket.acquire()
+    assert 0.38 < time.monotonic() - start < 0.6
+
+
+def test_token_bucket_order():
+    bucket = upload_tags.TokenBucket(1, 0.05)
+    bucket.acquire()
+    released = []
+
+    def acquire(i):
+        bucket.acquire()
+        released.append(i)
+
+    threads = []
+    for i in range(5):
+        threads.append(threading.Thread(target=acquire, args=(i, )))
+        threads[-1].start()
+        # Make sure that the threads ask for a token in order
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+    assert released == list(range(5))
+
+
+def test_upload_to_mock_server(tmp_path, monkeypatch):
+    # The same rate limit as the real server. It allows requests to arrive a bit closer together than they were
+    # sent, but not by enough for a much shorter interval
+    server = mock_musicbrainz.serve(0, latency=0.01, rate_limit_requests=upload_tags.RATE_LIMIT_REQUESTS,
+                                    rate_limit_interval=upload_tags.RATE_LIMIT_INTERVAL)
+    try:
+        monkeypatch.setattr(musicbrainzngs.musicbrainz, "hostname", f"localhost:{server.server_address[1]}")
+        monkeypatch.setattr(musicbrainzngs.musicbrainz, "https", False)
+        tags = {f"{i:08d}-0000-0000-0000-000000000000": ["rock", f"tag {i % 7}"] for i in range(120)}
+        tagfile = tmp_path / "tags.csv"
+        tagfile.write_text("".join(f"{mbid},{','.join(t)}\n" for mbid, t in tags.items()))
+        upload_tags.main("lastfm", str(tagfile), num_workers=4,
+                         chunk_sizer=upload_tags.ChunkSizer(initial=10, minimum=10, maximum=10))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert server.num_rate_limited == 0
+    assert server.num_requests == 12
+    assert server.submitted == tags
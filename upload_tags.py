@@ -1,41 +1,171 @@
 # Upload a list of tags to MusicBrainz
 
 import argparse
+import concurrent.futures
 import csv
+import heapq
+import itertools
 import json
-import math
 import os
+import sqlite3
+import tempfile
+import threading
 import time
 from datetime import timedelta
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
 
 import musicbrainzngs
 
+import tag_matrix
+
 musicbrainzngs.set_useragent("MB-Tagsubmit", "0.1", "https://github.com/metabrainz/genre-matching")
-# We have a temporary limit exemption, so do up to 5 queries per second
-musicbrainzngs.set_rate_limit(1, 5)
+# musicbrainzngs holds a lock for the whole of each request, even when its rate limit is turned off, so only one
+# request could be sent at a time. Use the request function without its rate limit wrapper, and limit the rate of
+# requests from all submitter threads with a TokenBucket instead.
+musicbrainzngs.set_rate_limit(False)
+musicbrainzngs.musicbrainz._mb_request = musicbrainzngs.musicbrainz._mb_request.fun
 
 musicbrainzngs.set_hostname("test.musicbrainz.org", True)
 
 musicbrainzngs.auth('user', 'mb')
 
 
+# Number of recordings to submit in one request at the start of an upload. This goes up while the server responds
+# quickly, and down when it is slow or returns errors, between MIN_ITEMS_PER_CHUNK and MAX_ITEMS_PER_CHUNK
 ITEMS_PER_CHUNK = 25
+MIN_ITEMS_PER_CHUNK = 5
+MAX_ITEMS_PER_CHUNK = 100
+# Make chunks smaller if a request takes longer than this many seconds, and larger if it's quicker
+TARGET_LATENCY = 2.0
+# How many times to send a chunk when the server can't be reached, before stopping the upload. The chunk isn't
+# added to the submit cache, so it's sent again when the upload is started again.
+# musicbrainzngs already retries a few times itself before giving up
+MAX_ATTEMPTS = 10
+# Seconds to wait before sending a chunk again, doubled after each attempt up to MAX_RETRY_DELAY
+RETRY_DELAY = 5.0
+MAX_RETRY_DELAY = 300.0
+# We have a temporary limit exemption, so do up to 5 queries per second
+RATE_LIMIT_REQUESTS = 5
+RATE_LIMIT_INTERVAL = 1.0
+# Number of requests that are sent at the same time, so that waiting for a response doesn't slow down the submission
+NUM_SUBMITTERS = 4
+# Number of mbids to look up in the submit cache in one query
+LOOKUP_BATCH_SIZE = 500
+# If a tag file isn't sorted by mbid, it's sorted in runs of this many rows at a time, which are then merged
+SORT_RUN_ROWS = 200000
+
+
+class TokenBucket:
+    """A thread-safe rate limiter that allows `requests` requests per `interval` seconds, with bursts of up to
+    `requests` requests after a pause"""
+
+    def __init__(self, requests: int, interval: float):
+        self.capacity = float(requests)
+        self.rate = requests / interval
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take a token even if there isn't one available yet, so that threads that are waiting
+            # get the next tokens in the order that they asked for them
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SubmitCache:
+    """The recording mbids that have been submitted, so that an upload can be restarted without submitting them again.
+
+    They are stored in a sqlite database next to the tag file (<tagfile>.submitcache.db). Each chunk is added in a
+    single transaction once it has been submitted, so saving a chunk takes the same time however many recordings have
+    already been submitted, and an interrupted upload never leaves a partly written cache. Checking if an mbid has
+    been submitted is an index lookup, so the cache doesn't have to be read when an upload is restarted.
+    """
+
+    def __init__(self, tagfile):
+        self.path = f"{tagfile}.submitcache.db"
+        is_new = not os.path.exists(self.path)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode a power failure can lose the last few commits, but not corrupt the database. At worst a few
+        # chunks are submitted again, which is harmless because a submission replaces the user's tags
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS submitted (mbid TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.commit()
+
+        # Import the json cache that was used before the database
+        json_cachefile = f"{tagfile}.submitcache"
+        if is_new and os.path.exists(json_cachefile):
+            with open(json_cachefile) as fp:
+                self.add(json.load(fp))
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM submitted").fetchone()[0]
+
+    def __contains__(self, mbid):
+        return self.conn.execute("SELECT 1 FROM submitted WHERE mbid = ?", (mbid, )).fetchone() is not None
 
+    def submitted(self, mbids) -> set:
+        """The mbids in `mbids` that have been submitted. This is a lot faster than checking them one at a time,
+        especially if they are sorted"""
+        found = set()
+        for batch in chunks(mbids, LOOKUP_BATCH_SIZE):
+            query = f"SELECT mbid FROM submitted WHERE mbid IN ({','.join('?' * len(batch))})"
+            found.update(mbid for mbid, in self.conn.execute(query, batch))
+        return found
 
-def load_submit_cache(tagfile):
-    cachefile = f"{tagfile}.submitcache"
+    def add(self, mbids):
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO submitted (mbid) VALUES (?)", ((m, ) for m in mbids))
 
-    if not os.path.exists(cachefile):
-        return []
-    with open(cachefile) as fp:
-        return json.load(fp)
+    def close(self):
+        self.conn.close()
 
+    def __enter__(self):
+        return self
 
-def save_submit_cache(tagfile, submitted_mbids):
-    cachefile = f"{tagfile}.submitcache"
+    def __exit__(self, *exc):
+        self.close()
 
-    with open(cachefile, 'w') as fp:
-        json.dump(submitted_mbids, fp)
+
+class ChunkSizer:
+    """Decide how many recordings to submit in each request, based on how long recent requests took and whether they
+    failed. Chunks grow while the server is quick, so that fewer requests are needed, and shrink quickly when it's
+    slow or can't be reached"""
+
+    def __init__(self, initial=ITEMS_PER_CHUNK, minimum=MIN_ITEMS_PER_CHUNK, maximum=MAX_ITEMS_PER_CHUNK,
+                 target_latency=TARGET_LATENCY):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self._size = float(min(max(initial, minimum), maximum))
+
+    @property
+    def size(self) -> int:
+        return round(self._size)
+
+    def success(self, latency: float):
+        if latency < self.target_latency:
+            self._size = min(self.maximum, self._size * 1.2)
+        else:
+            self._size = max(self.minimum, self._size * 0.8)
+
+    def failure(self):
+        self._size = max(self.minimum, self._size / 2)
+
+
+class Chunk(NamedTuple):
+    # rows of the tag file: mbid, followed by tags
+    rows: List[List[str]]
+    # How many times this chunk has failed
+    failures: int = 0
 
 
 def chunks(lst, n):
@@ -44,52 +174,280 @@ def chunks(lst, n):
         yield lst[i:i + n]
 
 
-def main(tagtype, tagfile):
-    submitted_items = load_submit_cache(tagfile)
-    submitted_set = set(submitted_items)
+def take(iterator, n) -> list:
+    """The next n items from iterator"""
+    return list(itertools.islice(iterator, n))
+
+
+def read_tag_file(tagfile) -> Iterator[List[str]]:
     with open(tagfile) as fp:
-        reader = csv.reader(fp)
-        tags = {}
-        for line in reader:
-            tags[line[0]] = line[1:]
+        yield from csv.reader(fp)
 
-        print(f"Loaded {len(tags)} tags")
-        tags = {k: v for k, v in tags.items() if k not in submitted_set}
-        print(f"After filtering submitted items, {len(tags)} tags remaining")
 
-    start = time.monotonic()
-    numtags = len(tags)
-    chunk_count = 0
-    numchunks = math.ceil(numtags/ITEMS_PER_CHUNK)
-    for mbids in chunks(list(sorted(tags.keys())), ITEMS_PER_CHUNK):
-        stopfile = f"{tagfile}.stop"
-        if os.path.exists(stopfile):
-            print("Stopfile found, exiting")
-            return
+def line_mbid(line: str) -> str:
+    """The mbid of a line of a tag file. mbids don't need to be quoted, so this is quicker than parsing the line"""
+    return line.partition(",")[0]
+
+
+def check_tag_file(tagfile) -> Tuple[int, bool]:
+    """Count the rows in a tag file, and check if they are sorted by mbid"""
+    count = 0
+    is_sorted = True
+    previous = ""
+    with open(tagfile) as fp:
+        for line in fp:
+            count += 1
+            mbid = line_mbid(line)
+            if mbid < previous:
+                is_sorted = False
+            previous = mbid
+    return count, is_sorted
 
-        to_submit = {}
-        for m in mbids:
-            to_submit[m] = tags[m]
-        
-        #print(to_submit)
-        chunkstart = time.monotonic()
+
+def sort_tag_file(tagfile, run_rows=SORT_RUN_ROWS) -> Iterator[List[str]]:
+    """The rows of a tag file, sorted by mbid, without reading more than `run_rows` rows into memory.
+    Sorted runs of lines are written to a temporary directory next to the tag file, and merged as they are read.
+    Rows with the same mbid stay in the same order as they are in the file"""
+    with open(tagfile) as fp, \
+            tempfile.TemporaryDirectory(prefix=".sort-", dir=os.path.dirname(os.path.abspath(tagfile))) as tmpdir:
+        runs = []
+        while True:
+            run = take(fp, run_rows)
+            if not run:
+                break
+            # The last line of the file may not end with a newline, and it could be sorted into the middle of the run
+            if not run[-1].endswith("\n"):
+                run[-1] += "\n"
+            run.sort(key=line_mbid)
+            path = os.path.join(tmpdir, f"run{len(runs)}.csv")
+            with open(path, "w") as out:
+                out.writelines(run)
+            runs.append(path)
+        run_files = [open(path) for path in runs]
         try:
-            musicbrainzngs.submit_tags(recording_tags=to_submit)
-            chunkend = time.monotonic()
-            print(f" ({round(chunkend-chunkstart, 2)})")
-            time.sleep(1)
+            yield from csv.reader(heapq.merge(*run_files, key=line_mbid))
+        finally:
+            for f in run_files:
+                f.close()
+
+
+def last_row_for_each_mbid(rows: Iterable[List[str]]) -> Iterator[List[str]]:
+    """If an mbid is in more than one of these rows (sorted by mbid), only keep the last one"""
+    previous = None
+    for row in rows:
+        if previous is not None and row[0] != previous[0]:
+            yield previous
+        previous = row
+    if previous is not None:
+        yield previous
+
+
+def unsubmitted_rows(rows: Iterable[List[str]], submit_cache: SubmitCache) -> Iterator[List[str]]:
+    rows = iter(rows)
+    while True:
+        batch = take(rows, LOOKUP_BATCH_SIZE)
+        if not batch:
+            return
+        submitted = submit_cache.submitted([row[0] for row in batch])
+        for row in batch:
+            if row[0] not in submitted:
+                yield row
+
+
+def sorted_tag_rows(tagfile) -> Iterator[List[str]]:
+    """The rows of a tag file or tag matrix in order of mbid, with only the last row for each mbid"""
+    if tag_matrix.is_tag_matrix(tagfile):
+        with tag_matrix.TagMatrix(tagfile) as matrix:
+            yield from matrix.rows()
+        return
+    _, is_sorted = check_tag_file(tagfile)
+    rows = read_tag_file(tagfile) if is_sorted else sort_tag_file(tagfile)
+    try:
+        yield from last_row_for_each_mbid(rows)
+    finally:
+        rows.close()
+
+
+def join_tag_rows(previous_rows: Iterable[List[str]],
+                  new_rows: Iterable[List[str]]) -> Iterator[Tuple[str, List[str], List[str]]]:
+    """Join two lists of rows that are sorted by mbid, giving (mbid, previous tags, new tags) for each mbid in
+    either of them. Only one row of each is in memory at a time"""
+    previous_rows = iter(previous_rows)
+    new_rows = iter(new_rows)
+    previous = next(previous_rows, None)
+    new = next(new_rows, None)
+    while previous is not None or new is not None:
+        if new is None or (previous is not None and previous[0] < new[0]):
+            yield previous[0], previous[1:], []
+            previous = next(previous_rows, None)
+        elif previous is None or new[0] < previous[0]:
+            yield new[0], [], new[1:]
+            new = next(new_rows, None)
+        else:
+            yield new[0], previous[1:], new[1:]
+            previous = next(previous_rows, None)
+            new = next(new_rows, None)
+
+
+def delta_rows(previous_rows: Iterable[List[str]], new_rows: Iterable[List[str]],
+               remove=False) -> Iterator[List[str]]:
+    """
+    The rows to submit to change the tags of each recording from the previous rows (which were already submitted)
+    to the new rows. A submission replaces the tags of a recording, so each row has all tags that the recording
+    should have, not just the ones that were added.
+    :param remove: if False, only add tags: a recording gets its previous tags and the tags that were added, and
+                   recordings that only had tags removed aren't submitted. If True, submit the new tags of each
+                   recording that changed, which removes the tags that are no longer in the new rows
+    """
+    for mbid, previous_tags, new_tags in join_tag_rows(previous_rows, new_rows):
+        previous_set, new_set = set(previous_tags), set(new_tags)
+        if remove:
+            if previous_set != new_set:
+                yield [mbid] + new_tags
+        elif not new_set <= previous_set:
+            yield [mbid] + sorted(previous_set | new_set)
+
+
+def write_delta(previous_tagfile, tagfile, remove=False) -> Tuple[str, int]:
+    """Write the rows from delta_rows for two tag files (or tag matrices) to a tag file next to tagfile,
+    and return its name and the number of rows"""
+    # The name depends on the previous file and on `remove`, so that each kind of delta has its own submit cache
+    deltafile = f"{tagfile}.since-{os.path.basename(previous_tagfile)}{'-remove' if remove else ''}.csv"
+    count = 0
+    with open(f"{deltafile}.tmp", "w") as fp:
+        writer = csv.writer(fp)
+        for row in delta_rows(sorted_tag_rows(previous_tagfile), sorted_tag_rows(tagfile), remove):
+            writer.writerow(row)
+            count += 1
+    os.replace(f"{deltafile}.tmp", deltafile)
+    return deltafile, count
+
+
+def retry_delay(failures: int) -> float:
+    return min(RETRY_DELAY * 2 ** (failures - 1), MAX_RETRY_DELAY)
+
+
+def submit_chunk(to_submit, limiter: TokenBucket, delay=0.0) -> float:
+    """Submit the tags for some recordings after waiting for `delay` seconds, and return how long the request took"""
+    if delay:
+        time.sleep(delay)
+    limiter.acquire()
+    chunkstart = time.monotonic()
+    musicbrainzngs.submit_tags(recording_tags=to_submit)
+    return time.monotonic() - chunkstart
+
+
+def main(tagtype, tagfile, num_workers=NUM_SUBMITTERS, rate_limit_requests=RATE_LIMIT_REQUESTS,
+         rate_limit_interval=RATE_LIMIT_INTERVAL, chunk_sizer=None, since=None, remove=False):
+    if chunk_sizer is None:
+        chunk_sizer = ChunkSizer()
+    stopfile = f"{tagfile}.stop"
+    if since:
+        # Upload the changes as a separate tag file, which has its own submit cache
+        tagfile, numchanged = write_delta(since, tagfile, remove)
+        print(f"{numchanged} recordings have different tags to {since}, written to {tagfile}")
+    submit_cache = SubmitCache(tagfile)
+    # The tag file is read as the tags are submitted, instead of being loaded first. Rows are submitted in order of
+    # their mbid, so if the file isn't sorted it is sorted first. A tag matrix is always sorted
+    matrix = None
+    if tag_matrix.is_tag_matrix(tagfile):
+        matrix = tag_matrix.TagMatrix(tagfile)
+        numrows, is_sorted = len(matrix), True
+    else:
+        numrows, is_sorted = check_tag_file(tagfile)
+    numsubmitted = len(submit_cache)
+    print(f"{numrows} tags in {tagfile}, {numsubmitted} already submitted")
+    if matrix is not None:
+        rows = matrix.rows()
+    elif is_sorted:
+        rows = read_tag_file(tagfile)
+    else:
+        print("Tags aren't sorted by mbid, sorting them")
+        rows = sort_tag_file(tagfile)
+    remaining_rows = unsubmitted_rows(last_row_for_each_mbid(rows), submit_cache)
+
+    start = time.monotonic()
+    # This is an estimate, because the submit cache can include mbids that are no longer in the tag file
+    numtags = max(numrows - numsubmitted, 1)
+    done_count = 0
+    limiter = TokenBucket(rate_limit_requests, rate_limit_interval)
+    stopped = False
+    # Chunks that have been given to a submitter but not finished yet
+    pending = {}
+    with submit_cache, concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+
+        def submit(chunk: Chunk, delay=0.0):
+            to_submit = {}
+            for row in chunk.rows:
+                to_submit[row[0]] = row[1:]
+            pending[executor.submit(submit_chunk, to_submit, limiter, delay)] = chunk
+
+        while True:
+            # Keep a few chunks waiting for each submitter, so that they always have one to send
+            while not stopped and len(pending) < num_workers * 2:
+                chunk_rows = take(remaining_rows, chunk_sizer.size)
+                if not chunk_rows:
+                    break
+                if os.path.exists(stopfile):
+                    print("Stopfile found, exiting")
+                    stopped = True
+                    break
+                submit(Chunk(chunk_rows))
+            if not pending:
+                break
+
+            # Chunks that were already sent are saved to the cache even after a stopfile is found
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    duration = future.result()
+                except (musicbrainzngs.ResponseError, musicbrainzngs.NetworkError) as e:
+                    if isinstance(e, musicbrainzngs.ResponseError):
+                        print(" - Error when processing", e.cause.reason, e.cause.headers)
+                        # The server rejected the request, so sending the same chunk again won't help.
+                        # This is about the recordings in the chunk, not the server, so the chunk size stays the same
+                        if stopped:
+                            continue
+                        if len(chunk.rows) > 1:
+                            # Split the chunk to find the recordings that fail, so that the rest can still be submitted
+                            half = len(chunk.rows) // 2
+                            submit(Chunk(chunk.rows[:half]))
+                            submit(Chunk(chunk.rows[half:]))
+                        else:
+                            print(f" - Skipping {chunk.rows[0][0]}")
+                        continue
+                    # The server can't be reached. This isn't caused by the recordings in the chunk, so splitting
+                    # it wouldn't help. Wait longer each time, and if it still fails, stop and leave the rest of the
+                    # tags to be submitted when the upload is started again
+                    print(" - Error when submitting", e)
+                    chunk_sizer.failure()
+                    failures = chunk.failures + 1
+                    if stopped:
+                        continue
+                    if failures < MAX_ATTEMPTS:
+                        delay = retry_delay(failures)
+                        print(f" - Retrying {len(chunk.rows)} recordings in {delay}s")
+                        submit(Chunk(chunk.rows, failures), delay)
+                    else:
+                        print(f"Couldn't reach the server after {failures} attempts, stopping. "
+                              f"Run again to submit the rest of the tags")
+                        stopped = True
+                    continue
+                print(f" ({round(duration, 2)})")
+                chunk_sizer.success(duration)
 
-            submitted_items += mbids
-            save_submit_cache(tagfile, submitted_items)
-            chunk_count += 1
-            print_status_update(chunk_count, numchunks, start)
-        except musicbrainzngs.musicbrainz.ResponseError as e:
-            print(" - Error when processing", e.cause.reason, e.cause.headers)
-            pass
+                submit_cache.add(row[0] for row in chunk.rows)
+                done_count += len(chunk.rows)
+                print_status_update(done_count, numtags, start)
+    # Remove the sorted runs if the upload was stopped before all rows were read
+    rows.close()
+    if matrix is not None:
+        matrix.close()
 
 
 def print_status_update(chunk_count, number_chunks, start_time):
-    """Print a basic status update based on how many chunks have been computed"""
+    """Print a basic status update based on how many recordings (or chunks) have been submitted"""
     chunk_time = time.monotonic()
     chunk_percentage = chunk_count / number_chunks
     duration = round(chunk_time - start_time)
@@ -105,9 +463,38 @@ def print_status_update(chunk_count, number_chunks, start_time):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument('--server', required=False,
+                        help='MusicBrainz server to submit to, as host[:port] (default test.musicbrainz.org)')
+    parser.add_argument('--no-https', action='store_true', help='Connect to the server with http')
+    parser.add_argument('-j', '--workers', type=int, default=NUM_SUBMITTERS,
+                        help=f'Number of requests to send at the same time (default {NUM_SUBMITTERS})')
+    parser.add_argument('--rate-limit', type=int, default=RATE_LIMIT_REQUESTS,
+                        help=f'Maximum number of requests per --rate-interval (default {RATE_LIMIT_REQUESTS})')
+    parser.add_argument('--rate-interval', type=float, default=RATE_LIMIT_INTERVAL,
+                        help=f'Length of the rate limit interval in seconds (default {RATE_LIMIT_INTERVAL})')
+    parser.add_argument('--chunk-size', type=int, default=ITEMS_PER_CHUNK,
+                        help=f'Number of recordings to submit in each request at the start (default {ITEMS_PER_CHUNK})')
+    parser.add_argument('--min-chunk-size', type=int, default=MIN_ITEMS_PER_CHUNK,
+                        help=f'Smallest number of recordings in a request (default {MIN_ITEMS_PER_CHUNK})')
+    parser.add_argument('--max-chunk-size', type=int, default=MAX_ITEMS_PER_CHUNK,
+                        help=f'Largest number of recordings in a request (default {MAX_ITEMS_PER_CHUNK})')
+    parser.add_argument('--target-latency', type=float, default=TARGET_LATENCY,
+                        help='Make requests smaller if they take longer than this many seconds, '
+                             f'and larger if they are quicker (default {TARGET_LATENCY})')
+    parser.add_argument('--since', required=False,
+                        help='A tag file that was already submitted. Only submit the recordings whose tags have '
+                             'changed since then, adding the new tags to them')
+    parser.add_argument('--remove', action='store_true',
+                        help='With --since, also remove tags that are no longer in the tag file')
     parser.add_argument('type', help='"rec" or "rg"')
     parser.add_argument('tagfile')
 
     args = parser.parse_args()
+    if args.remove and not args.since:
+        parser.error("--remove needs --since")
+    if args.server:
+        musicbrainzngs.set_hostname(args.server, not args.no_https)
 
-    main(args.type, args.tagfile)
+    chunk_sizer = ChunkSizer(args.chunk_size, args.min_chunk_size, args.max_chunk_size, args.target_latency)
+    main(args.type, args.tagfile, args.workers, args.rate_limit, args.rate_interval, chunk_sizer, args.since,
+         args.remove)